@@ -4,6 +4,7 @@ Markdown Uploader CLI
 コマンドラインインターフェースモジュール
 """
 import argparse
+import re
 import sys
 import os
 from pathlib import Path
@@ -13,13 +14,11 @@ import logging
 current_dir = Path(__file__).parent
 sys.path.insert(0, str(current_dir))
 
-# 必要なモジュールをインポート
-try:
-    # 既存のmain.pyから設定を読み込む方法を確認
-    import main
-except ImportError as e:
-    print(f"エラー: main.pyのインポートに失敗しました: {e}")
-    sys.exit(1)
+# アップロード本体（main.py）はサブプロセスで実行するため、ここではインポートしない。
+# notion_client や markdown_it の読み込みを避け、--help や --config を素早く返す
+
+# ドライランで画像の参照を数えるパターン
+_IMAGE_RE = re.compile(r'!\[.*?\]\((.*?)\)')
 
 
 def parse_arguments():
@@ -199,8 +198,7 @@ def main():
             print(f"行数: {len(lines)}")
             
             # 画像ファイルの検出
-            import re
-            images = re.findall(r'!\[.*?\]\((.*?)\)', content)
+            images = _IMAGE_RE.findall(content)
             if images:
                 print(f"画像: {len(images)}個")
                 for img in images[:5]:  # 最初の5個まで表示
@@ -14,18 +14,20 @@ from typing import Optional
 class Config:
     """設定クラス"""
     
-    # Notion設定
-    database_id: str
-    notion_token: str
+    # Notion設定（指定がなければ __post_init__ で認証ファイルから読み込む）
+    database_id: str = ''
+    notion_token: str = ''
+    # 使用するNotion APIのバージョン（ページ作成のリクエストはこのバージョンの形式で組み立てている）
+    notion_version: str = "2022-06-28"
     
-    # FTP設定
+    # FTP設定（ユーザーとパスワードは指定がなければ環境変数から読み込む）
     ftp_host: str = "m2.coreserver.jp"
     ftp_user: Optional[str] = None
     ftp_pass: Optional[str] = None
     ftp_directory: str = "public_html/assets"
     ftp_base_url: str = "http://massy.m2.coreserver.jp/assets"
     
-    # ImgBB設定
+    # ImgBB設定（指定がなければ環境変数から読み込む）
     imgbb_api_key: Optional[str] = None
     
     # Notion制限
@@ -35,8 +37,8 @@ class Config:
     # サポートされる動画ドメイン
     video_domains: tuple = ('youtube.com', 'youtu.be', 'vimeo.com')
     
-    def __init__(self):
-        """設定を初期化する"""
+    def __post_init__(self):
+        """引数で指定されなかった認証情報をファイルと環境変数から読み込む"""
         self._load_notion_config()
         self._load_ftp_config()
         self._load_imgbb_config()
@@ -46,23 +48,28 @@ class Config:
         config_dir = Path("~/.token/notion").expanduser()
         
         try:
-            self.database_id = (config_dir / ".terminal_memo_id").read_text(encoding='utf-8').strip()
-            self.notion_token = (config_dir / ".terminal_memo_token").read_text(encoding='utf-8').strip()
+            if not self.database_id:
+                self.database_id = (config_dir / ".terminal_memo_id").read_text(encoding='utf-8').strip()
+            if not self.notion_token:
+                self.notion_token = (config_dir / ".terminal_memo_token").read_text(encoding='utf-8').strip()
         except FileNotFoundError as e:
             logging.error(f"Notion認証ファイルが見つかりません: {e}")
             sys.exit(1)
     
     def _load_ftp_config(self):
         """FTP設定を読み込む"""
-        self.ftp_user = os.environ.get("FTP_USER")
-        self.ftp_pass = os.environ.get("FTP_PASS")
+        if self.ftp_user is None:
+            self.ftp_user = os.environ.get("FTP_USER")
+        if self.ftp_pass is None:
+            self.ftp_pass = os.environ.get("FTP_PASS")
         
         if not self.ftp_user or not self.ftp_pass:
             logging.warning("FTP認証情報が設定されていません。")
     
     def _load_imgbb_config(self):
         """ImgBB設定を読み込む"""
-        self.imgbb_api_key = os.environ.get("IMGBB_API_KEY")
+        if self.imgbb_api_key is None:
+            self.imgbb_api_key = os.environ.get("IMGBB_API_KEY")
     
     @property
     def has_ftp_config(self) -> bool:
@@ -2,25 +2,68 @@
 画像アップロード機能モジュール
 """
 
+import os
+import mmap
 import time
-import uuid
 import ftplib
 import base64
 import logging
-import traceback
+import threading
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import requests
 
 from .config import Config
 
 
+IMGBB_UPLOAD_URL = "https://api.imgbb.com/1/upload"
+
+# FTP転送時のブロックサイズ（既定の8KiBでは大きな画像で送信回数が多くなる）
+FTP_BLOCK_SIZE = 1024 * 1024
+
+# マルチパート形式が受け付けられなかったことを示すステータス（この場合だけbase64で送り直す）
+IMGBB_MULTIPART_REJECTED_STATUSES = frozenset({415})
+
+
 class ImageUploader:
     """画像アップロード処理を担当するクラス"""
     
     def __init__(self, config: Config):
         self.config = config
+        
+        # 空いているFTP接続（並列アップロードではスレッドごとに別の接続を使い、終わったら戻して使い回す）
+        self._idle_ftp: List[ftplib.FTP] = []
+        self._ftp_lock = threading.Lock()
+        
+        # ImgBBへのリクエスト用のセッション（Keep-Aliveのため使い回し、close() で閉じる）
+        self._http_session: Optional[requests.Session] = None
+        self._http_lock = threading.Lock()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    
+    def close(self):
+        """保持しているFTP接続とHTTPセッションを閉じる"""
+        with self._ftp_lock:
+            idle, self._idle_ftp = self._idle_ftp, []
+        for ftp in idle:
+            self._close_ftp(ftp)
+        
+        with self._http_lock:
+            session, self._http_session = self._http_session, None
+        if session is not None:
+            session.close()
+    
+    def _session(self) -> requests.Session:
+        """ImgBB用のHTTPセッションを返す（閉じた後に使われた場合は作り直す）"""
+        with self._http_lock:
+            if self._http_session is None:
+                self._http_session = requests.Session()
+            return self._http_session
     
     def get_image_url(self, local_path: Path) -> str:
         """画像URLを取得する"""
@@ -49,45 +92,101 @@ class ImageUploader:
         """FTPサーバーに画像をアップロードする"""
         try:
             timestamp = int(time.time())
-            file_uuid = str(uuid.uuid4())[:8].upper()
+            file_id = os.urandom(4).hex().upper()
             file_ext = local_path.suffix.lower()
-            file_name = f"{timestamp}_{file_uuid}{file_ext}"
+            file_name = f"{timestamp}_{file_id}{file_ext}"
             
-            with ftplib.FTP(self.config.ftp_host) as ftp:
-                ftp.login(user=self.config.ftp_user, passwd=self.config.ftp_pass)
-                ftp.cwd("public_html")
-                
+            ftp = self._acquire_ftp()
+            stored = False
+            if ftp is not None:
                 try:
-                    ftp.cwd("assets")
-                except ftplib.error_perm:
-                    ftp.mkd("assets")
-                    ftp.cwd("assets")
-                
-                with open(local_path, 'rb') as file:
-                    ftp.storbinary(f'STOR {file_name}', file)
+                    self._store_ftp(ftp, local_path, file_name)
+                    stored = True
+                except (ftplib.error_temp, EOFError, OSError):
+                    # 使い回していた接続が切れていた場合は再接続して再試行
+                    logging.info("FTP接続が切断されていたため再接続します")
+                    self._close_ftp(ftp)
+                except Exception:
+                    self._close_ftp(ftp)
+                    raise
+            
+            if not stored:
+                ftp = self._connect_ftp()
+                try:
+                    self._store_ftp(ftp, local_path, file_name)
+                except Exception:
+                    self._close_ftp(ftp)
+                    raise
+            
+            self._release_ftp(ftp)
             
             url = f"{self.config.ftp_base_url}/{file_name}"
             logging.info(f"FTPアップロード成功: {url}")
             return url
             
         except Exception as e:
-            logging.error(f"FTPアップロードエラー: {e}")
-            traceback.print_exc()
+            logging.exception(f"FTPアップロードエラー: {e}")
             return None
     
+    def _store_ftp(self, ftp: ftplib.FTP, local_path: Path, file_name: str):
+        """FTP接続でファイルを転送する"""
+        with open(local_path, 'rb', buffering=FTP_BLOCK_SIZE) as file:
+            ftp.storbinary(f'STOR {file_name}', file, blocksize=FTP_BLOCK_SIZE)
+    
+    def _acquire_ftp(self) -> Optional[ftplib.FTP]:
+        """空いているFTP接続を取り出す（なければNone）"""
+        with self._ftp_lock:
+            return self._idle_ftp.pop() if self._idle_ftp else None
+    
+    def _release_ftp(self, ftp: ftplib.FTP) -> None:
+        """使い終わったFTP接続を空き接続に戻す"""
+        with self._ftp_lock:
+            self._idle_ftp.append(ftp)
+    
+    def _connect_ftp(self) -> ftplib.FTP:
+        """FTPサーバーに接続してログインする"""
+        ftp = ftplib.FTP(self.config.ftp_host)
+        try:
+            ftp.login(user=self.config.ftp_user, passwd=self.config.ftp_pass)
+            ftp.cwd("public_html")
+            
+            try:
+                ftp.cwd("assets")
+            except ftplib.error_perm:
+                ftp.mkd("assets")
+                ftp.cwd("assets")
+        except Exception:
+            ftp.close()
+            raise
+        
+        return ftp
+    
+    def _close_ftp(self, ftp: ftplib.FTP):
+        """FTP接続を閉じる"""
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+    
     def _upload_to_imgbb(self, local_path: Path) -> Optional[str]:
         """ImgBBに画像をアップロードしてURLを取得する"""
         try:
-            with open(local_path, "rb") as f:
-                base64_image = base64.b64encode(f.read()).decode('utf-8')
+            # 空のファイルは画像として受け付けられず、mmapもできないため送信しない
+            if local_path.stat().st_size == 0:
+                logging.warning(f"空のファイルはImgBBにアップロードしません: {local_path}")
+                return None
             
-            payload = {
-                'image': base64_image,
-                'key': self.config.imgbb_api_key
-            }
-            
-            response = requests.post("https://api.imgbb.com/1/upload", data=payload)
-            response.raise_for_status()
+            try:
+                response = self._post_imgbb_multipart(local_path)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                logging.info(f"ImgBBへのマルチパート送信に失敗したためbase64で再試行します: {e}")
+                response = self._post_imgbb_base64(local_path)
+            except requests.HTTPError as e:
+                # APIキーの誤りなど、送信形式と関係のないエラーでは画像を送り直さない
+                if e.response is None or e.response.status_code not in IMGBB_MULTIPART_REJECTED_STATUSES:
+                    raise
+                logging.info(f"ImgBBがマルチパート形式を受け付けなかったためbase64で再試行します: {e}")
+                response = self._post_imgbb_base64(local_path)
             
             data = response.json().get('data', {})
             url = data.get('url', '')
@@ -98,6 +197,32 @@ class ImageUploader:
             return url
             
         except Exception as e:
-            logging.error(f"ImgBBアップロードエラー: {e}")
-            traceback.print_exc()
+            logging.exception(f"ImgBBアップロードエラー: {e}")
             return None
+    
+    def _post_imgbb_multipart(self, local_path: Path) -> requests.Response:
+        """画像をバイナリのままマルチパート形式で送信する"""
+        with open(local_path, "rb") as f:
+            response = self._session().post(
+                IMGBB_UPLOAD_URL,
+                data={'key': self.config.imgbb_api_key},
+                files={'image': (local_path.name, f)}
+            )
+        response.raise_for_status()
+        return response
+    
+    def _post_imgbb_base64(self, local_path: Path) -> requests.Response:
+        """画像をbase64エンコードしてフォーム形式で送信する"""
+        with open(local_path, "rb") as f:
+            # mmap経由でエンコードし、ファイル内容の中間コピーを作らない
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                base64_image = base64.b64encode(mm)
+        
+        payload = {
+            'image': base64_image,
+            'key': self.config.imgbb_api_key
+        }
+        
+        response = self._session().post(IMGBB_UPLOAD_URL, data=payload)
+        response.raise_for_status()
+        return response
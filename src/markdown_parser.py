@@ -3,56 +3,154 @@ Markdownパース機能モジュール
 """
 
 import re
+import types
+import functools
 from pathlib import Path
-from typing import Dict, Any, Tuple, List, Optional
+from typing import Dict, Any, Tuple, List, Optional, Iterator
+
+import yaml
+
+# libyamlが利用可能な場合はC実装のローダーを使う
+# （BaseLoaderは数値・真偽値・日付などに変換せず、スカラーを書かれたとおりの文字列で返す）
+try:
+    from yaml import CBaseLoader as _YamlLoader
+except ImportError:
+    from yaml import BaseLoader as _YamlLoader
+
+# 数式として扱うコードブロックの言語名
+MATH_LANGUAGES = frozenset({'math', 'latex', 'tex'})
+
+# Obsidianスタイルのコールアウトタイプと絵文字（キーは大文字、読み取り専用）
+CALLOUT_TYPES = types.MappingProxyType({
+    'NOTE': '📝',
+    'TIP': '💡',
+    'INFO': 'ℹ️',
+    'TODO': '☑️',
+    'IMPORTANT': '❗',
+    'WARNING': '⚠️',
+    'CAUTION': '⚠️',
+    'ERROR': '❌',
+    'DANGER': '🚨',
+    'EXAMPLE': '📋',
+    'QUOTE': '💬',
+    'ABSTRACT': '📄',
+    'SUCCESS': '✅',
+    'QUESTION': '❓',
+    'FAILURE': '❌',
+    'BUG': '🐛',
+    'FAQ': '❔',
+    'RESULT': '✨',  # 結果用の新しいタイプ
+    'PROMPT': '💬'   # プロンプト用の新しいタイプ
+})
+
+# LaTeXコードと判定するためのパターン
+_LATEX_PATTERNS: Tuple[str, ...] = (
+    r'\\begin{', r'\\end{', r'\\frac', r'\\sum', r'\\int',
+    r'\\lim', r'\\nabla', r'\\partial', r'\\alpha', r'\\beta',
+    r'\\gamma', r'\\delta', r'\\epsilon', r'\\zeta', r'\\eta',
+    r'\\theta', r'\\iota', r'\\kappa', r'\\lambda', r'\\mu',
+    r'\\nu', r'\\xi', r'\\pi', r'\\rho', r'\\sigma', r'\\tau',
+    r'\\upsilon', r'\\phi', r'\\chi', r'\\psi', r'\\omega',
+    r'\\left', r'\\right', r'\\mathbf', r'\\mathcal', r'\\mathrm',
+    r'\\cdot', r'\\times', r'\\div', r'\\pm', r'\\mp',
+    r'\\cap', r'\\cup', r'\\subset', r'\\supset', r'\\in',
+    r'\\notin', r'\\forall', r'\\exists', r'\\neg', r'\\vee',
+    r'\\wedge', r'\\Rightarrow', r'\\Leftarrow', r'\\Leftrightarrow'
+)
+_LATEX_PREFIX = r'\\'
+# 共通の接頭辞を括り出し、接頭辞が見つかった位置でだけ各コマンド名を試す
+_LATEX_RE = re.compile(
+    re.escape(_LATEX_PREFIX)
+    + '(?:' + '|'.join(re.escape(p[len(_LATEX_PREFIX):]) for p in _LATEX_PATTERNS) + ')'
+)
+
+# str.splitlines() が行の区切りとして扱う文字
+_LINE_BREAK_RE = re.compile('\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+
+@functools.lru_cache(maxsize=8)
+def _video_domain_re(video_domains: Tuple[str, ...]) -> re.Pattern:
+    """動画ドメインのいずれかを含むかを判定する正規表現を作成する"""
+    # ドメインが空の場合は何にも一致しないパターンにする
+    return re.compile('|'.join(map(re.escape, video_domains)) or '(?!)')
 
 
 class MarkdownParser:
     """Markdownファイルのパース処理を担当するクラス"""
     
-    # Obsidianスタイルのコールアウトタイプ
-    CALLOUT_TYPES = {
-        'NOTE': '📝',
-        'TIP': '💡',
-        'INFO': 'ℹ️',
-        'TODO': '☑️',
-        'IMPORTANT': '❗',
-        'WARNING': '⚠️',
-        'CAUTION': '⚠️',
-        'ERROR': '❌',
-        'DANGER': '🚨',
-        'EXAMPLE': '📋',
-        'QUOTE': '💬',
-        'ABSTRACT': '📄',
-        'SUCCESS': '✅',
-        'QUESTION': '❓',
-        'FAILURE': '❌',
-        'BUG': '🐛',
-        'FAQ': '❔',
-        'RESULT': '✨',  # 結果用の新しいタイプ
-        'PROMPT': '💬'   # プロンプト用の新しいタイプ
-    }
+    # Obsidianスタイルのコールアウトタイプ（モジュール定数を参照）
+    CALLOUT_TYPES = CALLOUT_TYPES
+    
+    # 事前コンパイル済みの正規表現パターン
+    _FRONTMATTER_RE = re.compile(r"^---\s*\n(.+?)\n---\s*\n(.*)$", re.S)
+    # 実行記録・接続先・プロンプトファイルを一度の走査で検出する
+    # （先読みで囲み、各パターンの最初の出現位置が互いに隠れないようにする）
+    _EXECUTION_METADATA_RE = re.compile(
+        r'(?=## 実行記録:\s*(?P<execution_time>\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})'
+        r'|\*\*接続先:\*\*\s*(?P<connection_host>.+?)(?:\s|$)'
+        r'|\*\*プロンプトファイル:\*\*\s*(?P<prompt_file>.+?)(?:\s|$))'
+    )
+    _EXECUTION_METADATA_KEYS = ('execution_time', 'connection_host', 'prompt_file')
+    _REMOTE_CLAUDE_HEADER_RE = re.compile(
+        r'^(?:(?P<execution>#{2,}\s+実行記録:)|(?P<prompt>###\s+プロンプト)|(?P<result>###\s+結果))'
+    )
+    _SECTION_HEADER_RE = re.compile(r'^#{1,3}\s+')
+    _LINK_RE = re.compile(r'\[(.*?)\]\((.*?)\)')
     
     @staticmethod
-    def parse_frontmatter_and_body(file_path: Path) -> Tuple[Dict[str, str], str]:
-        """フロントマターと本文を分離してパースする"""
+    def load_markdown(file_path: Path) -> Tuple[str, Dict[str, str], str]:
+        """ファイルを読み込み、テキスト全体・フロントマター・本文を返す"""
         try:
-            text = file_path.read_text(encoding='utf-8')
+            st = file_path.stat()
         except Exception as e:
             raise RuntimeError(f"ファイル読み込みに失敗: {e}")
         
-        fm_match = re.match(r"^---\s*\n(.+?)\n---\s*\n(.*)$", text, flags=re.S)
+        # 内容が変わっていなければ (パス, 更新時刻, サイズ) をキーにキャッシュを再利用
+        text, frontmatter, body = MarkdownParser._load_cached(str(file_path), st.st_mtime_ns, st.st_size)
+        return text, dict(frontmatter), body
+    
+    @staticmethod
+    def parse_frontmatter_and_body(file_path: Path) -> Tuple[Dict[str, str], str]:
+        """フロントマターと本文を分離してパースする"""
+        _, frontmatter, body = MarkdownParser.load_markdown(file_path)
+        return frontmatter, body
+    
+    @staticmethod
+    def parse_frontmatter_and_body_text(text: str) -> Tuple[Dict[str, str], str]:
+        """読み込み済みのテキストからフロントマターと本文を分離してパースする"""
+        return MarkdownParser._parse_parts(*MarkdownParser._split_frontmatter(text))
+    
+    @staticmethod
+    def _split_frontmatter(text: str) -> Tuple[Optional[str], str]:
+        """テキストをフロントマター部分と本文に分ける（フロントマターがなければNone）"""
+        # '---' で始まらないファイルでは正規表現を使わない
+        if not text.startswith('---'):
+            return None, text
         
+        fm_match = MarkdownParser._FRONTMATTER_RE.match(text)
         if fm_match:
-            fm_content, body = fm_match.group(1), fm_match.group(2)
-            frontmatter = {}
-            
-            for line in fm_content.splitlines():
-                if ':' in line:
-                    key, val = line.split(':', 1)
-                    frontmatter[key.strip()] = val.strip()
+            return fm_match.group(1), fm_match.group(2)
+        return None, text
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def _load_cached(path_str: str, mtime_ns: int, size: int) -> Tuple[str, Dict[str, str], str]:
+        """ファイルを読み込んでフロントマターと本文をパースする（キャッシュ対象）"""
+        try:
+            text = Path(path_str).read_text(encoding='utf-8')
+        except Exception as e:
+            raise RuntimeError(f"ファイル読み込みに失敗: {e}")
+        
+        frontmatter, body = MarkdownParser.parse_frontmatter_and_body_text(text)
+        return text, frontmatter, body
+    
+    @staticmethod
+    def _parse_parts(fm_content: Optional[str], body: str) -> Tuple[Dict[str, str], str]:
+        """フロントマター部分と本文からメタデータを組み立てる"""
+        if fm_content is not None:
+            frontmatter = MarkdownParser._parse_frontmatter(fm_content)
         else:
-            frontmatter, body = {}, text
+            frontmatter = {}
         
         # 実行記録のメタデータを抽出（remote-claude形式）
         execution_metadata = MarkdownParser._extract_execution_metadata(body)
@@ -61,28 +159,61 @@ class MarkdownParser:
         
         return frontmatter, body
     
+    @staticmethod
+    def _parse_frontmatter(fm_content: str) -> Dict[str, str]:
+        """フロントマターをYAMLとしてパースする（値は書かれたとおりの文字列に揃える）"""
+        # 「キー: 値」の行単位で読み取った値（YAMLとして扱えない値の代わりに使う）
+        line_values = {}
+        # インデントされていない行の値（YAMLのトップレベルのキーに対応する）
+        top_level_values = {}
+        for line in fm_content.split('\n'):
+            key, sep, val = line.partition(':')
+            if sep:
+                line_values[key.strip()] = val.strip()
+                if not line[:1].isspace():
+                    top_level_values[key.strip()] = val.strip()
+        
+        try:
+            data = yaml.load(fm_content, Loader=_YamlLoader)
+        except yaml.YAMLError:
+            data = None
+        
+        if not isinstance(data, dict):
+            # YAMLとして解釈できない場合は行単位で読み取った値を使う
+            return line_values
+        
+        frontmatter = {}
+        for key, val in data.items():
+            key = str(key)
+            if isinstance(val, list) and all(isinstance(item, str) for item in val):
+                # 文字列のリスト（tags など）はカンマ区切りにする
+                frontmatter[key] = ', '.join(val)
+            elif isinstance(val, str) and val:
+                # 引用符で囲まれた値は引用符を外した内容になる
+                frontmatter[key] = val
+            else:
+                # 空の値（「title: #見出し」のようにコメント扱いになったものを含む）や、
+                # 入れ子のマッピング・リストは行に書かれたとおりの値にする
+                frontmatter[key] = top_level_values.get(key, '')
+        return frontmatter
+    
     @staticmethod
     def _extract_execution_metadata(text: str) -> Dict[str, str]:
         """実行記録のメタデータを抽出する"""
-        metadata = {}
+        found = {}
         
-        # 実行記録のパターンを検索
-        execution_pattern = r'## 実行記録:\s*(\d{4}-\d{2}-\d{2}\s+\d{2}:\d{2}:\d{2})'
-        match = re.search(execution_pattern, text)
-        if match:
-            metadata['execution_time'] = match.group(1)
+        for match in MarkdownParser._EXECUTION_METADATA_RE.finditer(text):
+            key = match.lastgroup
+            if key not in found:
+                found[key] = match.group(key)
+                if len(found) == len(MarkdownParser._EXECUTION_METADATA_KEYS):
+                    break
         
-        # 接続先の抽出
-        host_pattern = r'\*\*接続先:\*\*\s*(.+?)(?:\s|$)'
-        match = re.search(host_pattern, text)
-        if match:
-            metadata['connection_host'] = match.group(1).strip()
-        
-        # プロンプトファイルの抽出
-        prompt_file_pattern = r'\*\*プロンプトファイル:\*\*\s*(.+?)(?:\s|$)'
-        match = re.search(prompt_file_pattern, text)
-        if match:
-            metadata['prompt_file'] = match.group(1).strip()
+        # 実行記録、接続先、プロンプトファイルの順に格納
+        metadata = {}
+        for key in MarkdownParser._EXECUTION_METADATA_KEYS:
+            if key in found:
+                metadata[key] = found[key] if key == 'execution_time' else found[key].strip()
         
         return metadata
     
@@ -98,37 +229,38 @@ class MarkdownParser:
         while i < len(lines):
             line = lines[i]
             
-            # 実行記録セクションの処理
-            if re.match(r'^#{2,}\s+実行記録:', line):
-                processed_lines.append(re.sub(r'^#{2,}\s+実行記録:', '## 📊 実行記録:', line))
-                i += 1
-                continue
-            
-            # プロンプトセクションの処理
-            if re.match(r'^###\s+プロンプト', line):
-                processed_lines.append('### 💬 プロンプト')
-                i += 1
-                continue
-            
-            # 結果セクションの開始を検出
-            if re.match(r'^###\s+結果', line):
-                processed_lines.append('### ✨ 結果')
-                # 結果セクションをコールアウト形式で開始
-                processed_lines.append('> [!RESULT] 実行結果')
-                in_result_section = True
-                result_section_started = True
+            # 実行記録・プロンプト・結果の見出しを一度の照合で判定
+            # （見出しは必ず '#' で始まるため、それ以外の行では正規表現を使わない）
+            is_heading = line.startswith('#')
+            header_match = MarkdownParser._REMOTE_CLAUDE_HEADER_RE.match(line) if is_heading else None
+            if header_match:
+                header_kind = header_match.lastgroup
+                
+                if header_kind == 'execution':
+                    # 実行記録セクションの処理
+                    processed_lines.append('## 📊 実行記録:' + line[header_match.end():])
+                elif header_kind == 'prompt':
+                    # プロンプトセクションの処理
+                    processed_lines.append('### 💬 プロンプト')
+                else:
+                    # 結果セクションの開始を検出
+                    processed_lines.append('### ✨ 結果')
+                    # 結果セクションをコールアウト形式で開始
+                    processed_lines.append('> [!RESULT] 実行結果')
+                    in_result_section = True
+                    result_section_started = True
                 i += 1
                 continue
             
             # 結果セクション内の処理
             if in_result_section:
                 # 次のセクションの開始を検出（## や --- など）
-                if re.match(r'^#{1,3}\s+', line) or line.strip() == '---':
+                if (is_heading and MarkdownParser._SECTION_HEADER_RE.match(line)) or line.strip() == '---':
                     in_result_section = False
                     processed_lines.append(line)
                 else:
                     # 結果内容を引用ブロック化
-                    if line.strip():  # 空行でない場合
+                    if line and not line.isspace():  # 空行でない場合
                         # すでに引用記号がある場合はそのまま、ない場合は追加
                         if not line.startswith('>'):
                             processed_lines.append(f'> {line}')
@@ -149,20 +281,17 @@ class MarkdownParser:
     @staticmethod
     def extract_markdown_links(text: str) -> List[Dict[str, Any]]:
         """Markdownのリンク構文からリンク情報を抽出する"""
-        pattern = r'\[(.*?)\]\((.*?)\)'
-        matches = list(re.finditer(pattern, text))
-        links = []
-        
-        for match in matches:
-            links.append({
+        return [
+            {
                 'text': match.group(1),
                 'url': match.group(2),
                 'original': match.group(0),
-                'start': match.start(),
-                'end': match.end()
-            })
-        
-        return links
+                'start': start,
+                'end': end
+            }
+            for match in MarkdownParser._LINK_RE.finditer(text)
+            for start, end in (match.span(),)
+        ]
     
     @staticmethod
     def split_long_text(text: str, max_length: int = 2000) -> List[str]:
@@ -171,52 +300,56 @@ class MarkdownParser:
             return [text]
         
         chunks = []
-        current_chunk = ""
+        start = 0  # 現在のチャンクの開始位置
+        end = 0    # 現在のチャンクに含めた行の終端
         
-        for line in text.splitlines(True):  # keepends=True で改行を維持
-            if len(current_chunk) + len(line) > max_length:
-                if current_chunk:
-                    chunks.append(current_chunk)
-                    current_chunk = line
+        # 行の区切りを位置で追い、チャンクは元のテキストから一度だけ切り出す
+        for line_end in MarkdownParser._iter_line_ends(text):
+            line_start = end
+            if (end - start) + (line_end - line_start) > max_length:
+                if end > start:
+                    chunks.append(text[start:end])
+                    start = line_start
                 else:
                     # 1行が最大長を超える場合は、文字単位で分割
-                    while len(line) > max_length:
-                        chunks.append(line[:max_length])
-                        line = line[max_length:]
-                    current_chunk = line
-            else:
-                current_chunk += line
+                    while line_end - line_start > max_length:
+                        chunks.append(text[line_start:line_start + max_length])
+                        line_start += max_length
+                    start = line_start
+            
+            end = line_end
         
-        if current_chunk:
-            chunks.append(current_chunk)
+        if end > start:
+            chunks.append(text[start:end])
         
         return chunks
     
+    @staticmethod
+    def _iter_line_ends(text: str) -> Iterator[int]:
+        """str.splitlines(True) と同じ区切りで、各行の終端位置（改行を含む）を順に返す"""
+        end = 0
+        for match in _LINE_BREAK_RE.finditer(text):
+            end = match.end()
+            yield end
+        if end < len(text):
+            yield len(text)
+    
     @staticmethod
     def is_latex_code_block(lang: str, content: str) -> bool:
         """コードブロックがLaTeXコードかどうかを判定する"""
         # 言語指定が数学関連かどうか
-        if lang in ('math', 'latex', 'tex'):
+        if lang in MATH_LANGUAGES:
             return True
         
-        # 内容がLaTeXのパターンを含むかどうか
-        latex_patterns = [
-            r'\\begin{', r'\\end{', r'\\frac', r'\\sum', r'\\int', 
-            r'\\lim', r'\\nabla', r'\\partial', r'\\alpha', r'\\beta',
-            r'\\gamma', r'\\delta', r'\\epsilon', r'\\zeta', r'\\eta',
-            r'\\theta', r'\\iota', r'\\kappa', r'\\lambda', r'\\mu',
-            r'\\nu', r'\\xi', r'\\pi', r'\\rho', r'\\sigma', r'\\tau',
-            r'\\upsilon', r'\\phi', r'\\chi', r'\\psi', r'\\omega',
-            r'\\left', r'\\right', r'\\mathbf', r'\\mathcal', r'\\mathrm',
-            r'\\cdot', r'\\times', r'\\div', r'\\pm', r'\\mp',
-            r'\\cap', r'\\cup', r'\\subset', r'\\supset', r'\\in',
-            r'\\notin', r'\\forall', r'\\exists', r'\\neg', r'\\vee',
-            r'\\wedge', r'\\Rightarrow', r'\\Leftarrow', r'\\Leftrightarrow'
-        ]
+        # パターンはすべて共通の接頭辞で始まるため、含まなければ走査しない
+        if _LATEX_PREFIX not in content:
+            return False
         
-        return any(pattern in content for pattern in latex_patterns)
+        # 内容がLaTeXのパターンを含むかどうか（単一の正規表現で一度だけ走査）
+        return bool(_LATEX_RE.search(content))
     
     @staticmethod
     def is_video_link(url: str, video_domains: tuple) -> bool:
         """URLが動画リンクかどうかを判定する"""
-        return bool(url) and any(domain in url for domain in video_domains)
+        # ドメインをまとめた正規表現で一度だけ走査する（ドメインの組ごとにコンパイル結果を再利用）
+        return bool(url) and _video_domain_re(video_domains).search(url) is not None
@@ -2,18 +2,197 @@
 MarkdownからNotionブロックへの変換機能モジュール
 """
 
+import os
 import re
+import types
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Any, Set, Optional
+from typing import List, Dict, Any, Tuple, Iterable, Iterator, Generator
 
 from markdown_it import MarkdownIt
+from markdown_it.token import Token
 
 from .config import Config
-from .markdown_parser import MarkdownParser
+from .markdown_parser import MarkdownParser, MATH_LANGUAGES, CALLOUT_TYPES
 from .image_uploader import ImageUploader
 
 
+# Obsidianスタイルのリンク [[...]]
+_OBSIDIAN_LINK_RE = re.compile(r"\[\[(.+?)\]\]")
+
+# 数式・画像
+_BLOCK_MATH_RE = re.compile(r'\$\$\s*(.*?)\s*\$\$', re.DOTALL)
+_INLINE_MATH_RE = re.compile(r'\$([^$\n]+)\$')
+_IMAGE_RE = re.compile(r'!\[([^\]]*)\]\(([^)]+)\)')
+
+# Notion APIで無効な言語名の変換表
+_LANGUAGE_MAPPING = types.MappingProxyType({
+    'text': 'plain text',
+    'txt': 'plain text',
+    'plaintext': 'plain text',
+    'sh': 'shell',
+    'bash': 'shell',
+    'zsh': 'shell',
+    'js': 'javascript',
+    'ts': 'typescript',
+    'py': 'python',
+    'rb': 'ruby',
+    'yml': 'yaml',
+    'md': 'markdown',
+    '': 'plain text'
+})
+
+# Obsidianコールアウト（見出し行と、それに続く引用行または空行）、ブロック数式、
+# Obsidianスタイルのリンクを一度の走査で検出する
+_MARKDOWN_SCAN_RE = re.compile(
+    r'(?P<callout>^>[^\S\n]*\[!(?P<callout_type>\w+)\](?:[^\S\n]*(?P<callout_title>.*))?'
+    r'(?P<callout_body>(?:\n(?:>.*|[^\S\n]*$))*))'
+    r'|\$\$\s*(?P<math>(?s:.*?))\s*\$\$'
+    r'|\[\[(?P<link>.+?)\]\]',
+    re.MULTILINE
+)
+
+# 走査結果の中でブロック数式の位置を示す目印
+_MATH_PLACEHOLDER = '\0'
+
+# remote-claude形式の判定パターン（REMOTE_CLAUDE_MIN_MATCHES 個以上マッチすればremote-claude形式）
+REMOTE_CLAUDE_MIN_MATCHES = 3
+_REMOTE_CLAUDE_PATTERNS = tuple(re.compile(pattern) for pattern in (
+    r'## 実行記録:\s*\d{4}-\d{2}-\d{2}',
+    r'\*\*接続先:\*\*',
+    r'\*\*プロンプトファイル:\*\*',
+    r'### プロンプト',
+    r'### 結果'
+))
+
+# remote-claude形式のセクション解析
+_EXEC_HEADER_RE = re.compile(r'^##\s*実行記録:\s*(.+)$')
+_EXEC_SECTION_RE = re.compile(r'^##\s+実行記録:')
+_METADATA_LINE_RE = re.compile(r'\*\*([^:]+):\*\*\s*(.+)')
+_PROMPT_HEADER_RE = re.compile(r'^###\s+プロンプト')
+_RESULT_HEADER_RE = re.compile(r'^###\s+結果')
+
+# リストの開始・終了トークン
+_LIST_OPEN_TYPES = frozenset({'bullet_list_open', 'ordered_list_open'})
+_LIST_CLOSE_TYPES = frozenset({'bullet_list_close', 'ordered_list_close'})
+
+# 行頭にあるとブロック要素になりうる文字（段落以外になりうる1行は解析に回す）
+_BLOCK_START_CHARS = frozenset('#>-*+_`~<[0123456789')
+
+# rich_textの長さ制限を適用するブロックの種類
+_RICH_TEXT_BLOCK_TYPES = frozenset({
+    'paragraph', 'heading_1', 'heading_2', 'heading_3', 'quote',
+    'bulleted_list_item', 'numbered_list_item', 'toggle', 'callout'
+})
+
+# トグル内の子要素の上限
+MAX_TOGGLE_CHILDREN = 50
+
+# 画像アップロードの同時実行数（FTPサーバーの接続数制限を考慮して控えめにする）
+IMAGE_UPLOAD_WORKERS = 4
+
+
+def _is_blank(text: str) -> bool:
+    """空白文字だけからなるか（strip() と違ってコピーを作らない）"""
+    return not text or text.isspace()
+
+
+def _strip_obsidian_links(text: str) -> str:
+    """Obsidianスタイルのリンク [[...]] を中身のテキストに置き換える"""
+    return _OBSIDIAN_LINK_RE.sub(r"\1", text) if '[[' in text else text
+
+
+def _image_file_key(path: Path) -> Any:
+    """画像ファイルの同一性を表すキー（同じファイルを指す別のパスは同じキーになる）"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        # 存在しないファイルはパスそのものをキーにする
+        return path
+    return (st.st_dev, st.st_ino)
+
+
+def _scan_list_items(tokens: List[Token], i: int) -> Tuple[List[Tuple[str, str]], int]:
+    """tokens[i] のリストから対応する終了トークンまでを走査し、各アイテムの(ブロック種別, 内容)と次の位置を返す
+    
+    アイテムの内容は最初のインライントークンとする。入れ子のリストのアイテムも同じ階層に並べる。
+    """
+    token_count = len(tokens)
+    items = []
+    # 入れ子になっているリストのブロック種別（末尾が現在のリスト）
+    list_types = []
+    # 内容をまだ取り出していないリストアイテムの種別
+    pending = None
+    while i < token_count:
+        tok_type = tokens[i].type
+        if tok_type == 'inline':
+            if pending:
+                items.append((pending, tokens[i].content))
+                pending = None
+        elif tok_type == 'list_item_open':
+            pending = list_types[-1]
+        elif tok_type == 'list_item_close':
+            if pending:
+                # インラインの内容がないアイテム（空のアイテムやコードブロックだけのアイテム）
+                items.append((pending, ''))
+                pending = None
+        elif tok_type in _LIST_OPEN_TYPES:
+            list_types.append('numbered_list_item' if tok_type == 'ordered_list_open' else 'bulleted_list_item')
+        elif tok_type in _LIST_CLOSE_TYPES:
+            list_types.pop()
+            if not list_types:
+                return items, i + 1
+        i += 1
+    return items, i
+
+
+# ブロック生成ヘルパー
+def _text(content: str) -> Dict[str, Any]:
+    """rich_textのテキスト要素を作成"""
+    return {'type': 'text', 'text': {'content': content}}
+
+
+def _inline_equation(expression: str) -> Dict[str, Any]:
+    """rich_textのインライン数式要素を作成"""
+    return {'type': 'equation', 'equation': {'expression': expression}}
+
+
+def _rich_text_block(block_type: str, content: str, **props) -> Dict[str, Any]:
+    """テキスト1つをrich_textに持つブロックを作成"""
+    return {'object': 'block', 'type': block_type, block_type: {'rich_text': [_text(content)], **props}}
+
+
+def _paragraph(content: str) -> Dict[str, Any]:
+    return _rich_text_block('paragraph', content)
+
+
+def _heading(level: int, content: str) -> Dict[str, Any]:
+    """見出しブロックを作成（NotionはH3まで）"""
+    return _rich_text_block(f"heading_{min(level, 3)}", content)
+
+
+def _quote(content: str) -> Dict[str, Any]:
+    return _rich_text_block('quote', content)
+
+
+def _equation(expression: str) -> Dict[str, Any]:
+    return {'object': 'block', 'type': 'equation', 'equation': {'expression': expression}}
+
+
+def _code(language: str, content: str) -> Dict[str, Any]:
+    return {'object': 'block', 'type': 'code', 'code': {'language': language, 'rich_text': [_text(content)]}}
+
+
+def _divider() -> Dict[str, Any]:
+    return {'object': 'block', 'type': 'divider', 'divider': {}}
+
+
+def _image(url: str) -> Dict[str, Any]:
+    """外部URLの画像ブロックを作成（ローカル画像のURLは後から埋める）"""
+    return {'object': 'block', 'type': 'image', 'image': {'external': {'url': url}}}
+
+
 class NotionBlockConverter:
     """MarkdownからNotionブロックへの変換を担当するクラス"""
     
@@ -21,13 +200,54 @@ class NotionBlockConverter:
         self.config = config
         self.parser = MarkdownParser()
         self.image_uploader = ImageUploader(config)
-        self.md = MarkdownIt('commonmark', {'linkify': True})
+        # 変換はインライントークンの content しか使わないため、インライン解析（子トークンの生成）は行わない
+        # （commonmark プリセットでは linkify ルール自体が無効なので、linkify オプションは付けない）
+        self.md = MarkdownIt('commonmark').disable(['inline', 'text_join'])
+        
+        # 処理済み画像のURL（同じ画像は二度アップロードしない）
+        self._image_urls: Dict[Path, str] = {}
+        # ファイルの同一性（_image_file_key）ごとのURL（別のパスで参照された同じファイル用）
+        self._image_file_urls: Dict[Any, str] = {}
+        
+        # URL解決待ちの画像ブロック（変換後にまとめてアップロードする）
+        self._pending_images: List[Tuple[Dict[str, Any], Path]] = []
+        
+        # トークン種別ごとの処理（tokens, i, md_dir を受け取りブロックを順に生成し、次の位置を返す）
+        self._block_handlers = {
+            'heading_open': lambda tokens, i, md_dir: self._process_heading(tokens, i),
+            'bullet_list_open': lambda tokens, i, md_dir: self._process_list(tokens, i),
+            'ordered_list_open': lambda tokens, i, md_dir: self._process_list(tokens, i),
+            'paragraph_open': self._process_paragraph,
+            'fence': lambda tokens, i, md_dir: self._process_code_block(tokens, i),
+            'blockquote_open': lambda tokens, i, md_dir: self._process_blockquote(tokens, i),
+            'hr': lambda tokens, i, md_dir: self._process_divider(tokens, i),
+        }
         
-        # 処理済み画像の追跡
-        self.processed_images: Set[str] = set()
+        # トグル内（remote-claude形式の結果）でのトークン種別ごとの処理
+        self._toggle_handlers = {
+            'heading_open': lambda tokens, i, md_dir: self._process_heading_for_toggle(tokens, i),
+            'bullet_list_open': lambda tokens, i, md_dir: self._process_list_for_toggle(tokens, i),
+            'ordered_list_open': lambda tokens, i, md_dir: self._process_list_for_toggle(tokens, i),
+            'paragraph_open': self._process_paragraph_for_toggle,
+            'fence': lambda tokens, i, md_dir: self._process_code_block(tokens, i),
+            'blockquote_open': lambda tokens, i, md_dir: self._process_blockquote_for_toggle(tokens, i),
+            'hr': lambda tokens, i, md_dir: self._process_divider(tokens, i),
+            'inline': lambda tokens, i, md_dir: self._process_inline_for_toggle(tokens, i),
+        }
     
     def convert_markdown_to_blocks(self, md_text: str, md_dir: Path) -> List[Dict[str, Any]]:
         """MarkdownテキストをNotionブロックに変換する"""
+        blocks = self._convert_blocks(md_text, md_dir)
+        
+        # ローカル画像を並列にアップロードしてURLを埋める
+        self._resolve_pending_images()
+        
+        return blocks
+    
+    def _convert_blocks(self, md_text: str, md_dir: Path) -> List[Dict[str, Any]]:
+        """Markdownテキストをブロックに変換する（ローカル画像は_pending_imagesに溜める）"""
+        self._pending_images = []
+        
         # remote-claude形式かどうかを判定
         is_remote_claude = self._is_remote_claude_format(md_text)
         
@@ -38,32 +258,27 @@ class NotionBlockConverter:
         else:
             # 通常のMarkdown処理
             logging.info("通常のMarkdown形式として処理します")
-            # Obsidianスタイルのリンクを変換
-            md_text = re.sub(r"\[\[(.+?)\]\]", r"\1", md_text)
-            
-            # コールアウトを処理
-            md_text = self._process_callouts(md_text)
             
-            # 直接的にブロック数式を検出して変換
-            blocks = []
-            self._process_text_with_block_math(md_text, md_dir, blocks)
-            
-            return self._validate_blocks(blocks)
+            # コールアウト・ブロック数式・Obsidianリンクを検出して変換（生成しながら検証し、
+            # ブロック数の上限に達したら残りは変換しない）
+            return self._validate_blocks(self._process_text_with_block_math(md_text, md_dir))
     
     def _is_remote_claude_format(self, md_text: str) -> bool:
         """remote-claude形式かどうかを判定"""
-        # より厳密な判定パターン
-        patterns = [
-            r'## 実行記録:\s*\d{4}-\d{2}-\d{2}',
-            r'\*\*接続先:\*\*',
-            r'\*\*プロンプトファイル:\*\*',
-            r'### プロンプト',
-            r'### 結果'
-        ]
-        
-        # 少なくとも3つ以上のパターンがマッチすればremote-claude形式と判定
-        matches = sum(1 for pattern in patterns if re.search(pattern, md_text))
-        return matches >= 3
+        # 少なくとも REMOTE_CLAUDE_MIN_MATCHES 個のパターンがマッチすればremote-claude形式と判定
+        # （各パターンは固定文字列で始まり個別の search が速いため、まとめずに順に調べ、判定が決まった時点で打ち切る）
+        hits = misses = 0
+        max_misses = len(_REMOTE_CLAUDE_PATTERNS) - REMOTE_CLAUDE_MIN_MATCHES
+        for pattern in _REMOTE_CLAUDE_PATTERNS:
+            if pattern.search(md_text):
+                hits += 1
+                if hits >= REMOTE_CLAUDE_MIN_MATCHES:
+                    return True
+            else:
+                misses += 1
+                if misses > max_misses:
+                    return False
+        return False
     
     def _convert_remote_claude_format(self, md_text: str, md_dir: Path) -> List[Dict[str, Any]]:
         """remote-claude形式を特別に処理"""
@@ -76,35 +291,16 @@ class NotionBlockConverter:
         
         # 実行記録ヘッダー
         if sections.get('execution_header'):
-            blocks.append({
-                'object': 'block',
-                'type': 'heading_2',
-                'heading_2': {
-                    'rich_text': [{'type': 'text', 'text': {'content': f"📊 {sections['execution_header']}"}}]
-                }
-            })
+            blocks.append(_heading(2, f"📊 {sections['execution_header']}"))
         
         # メタデータ
         if sections.get('metadata'):
             for meta_line in sections['metadata']:
-                blocks.append({
-                    'object': 'block',
-                    'type': 'bulleted_list_item',
-                    'bulleted_list_item': {
-                        'rich_text': [{'type': 'text', 'text': {'content': meta_line}}],
-                        'color': 'gray_background'
-                    }
-                })
+                blocks.append(_rich_text_block('bulleted_list_item', meta_line, color='gray_background'))
         
         # プロンプトセクション
         if sections.get('prompt_title'):
-            blocks.append({
-                'object': 'block',
-                'type': 'heading_3',
-                'heading_3': {
-                    'rich_text': [{'type': 'text', 'text': {'content': '💬 プロンプト'}}]
-                }
-            })
+            blocks.append(_heading(3, '💬 プロンプト'))
             
             # プロンプト内容を引用ブロックとして追加
             if sections.get('prompt_content'):
@@ -112,15 +308,7 @@ class NotionBlockConverter:
                 logging.info(f"プロンプト内容: {prompt_text[:100]}...")
                 
                 # プロンプトをコールアウトとして表示
-                blocks.append({
-                    'object': 'block',
-                    'type': 'callout',
-                    'callout': {
-                        'rich_text': [{'type': 'text', 'text': {'content': prompt_text}}],
-                        'icon': {'emoji': '💬'},
-                        'color': 'blue_background'
-                    }
-                })
+                blocks.append(_rich_text_block('callout', prompt_text, icon={'emoji': '💬'}, color='blue_background'))
         
         # 結果セクション（トグル内に配置）
         if sections.get('result_content'):
@@ -128,28 +316,16 @@ class NotionBlockConverter:
             logging.info(f"結果内容の長さ: {len(result_content)} 文字")
             
             # 結果のヘッダー
-            blocks.append({
-                'object': 'block',
-                'type': 'heading_3',
-                'heading_3': {
-                    'rich_text': [{'type': 'text', 'text': {'content': '✨ 結果'}}]
-                }
-            })
+            blocks.append(_heading(3, '✨ 結果'))
             
             # 結果ブロックを作成
-            result_children = self._create_result_blocks(result_content, md_dir)
+            result_children = list(self._create_result_blocks(result_content, md_dir))
+            logging.info(f"生成されたブロック数: {len(result_children)}")
             
             logging.info(f"結果ブロック数: {len(result_children)}")
             
             # トグルブロックを作成し、子要素を含める
-            toggle_block = {
-                'object': 'block',
-                'type': 'toggle',
-                'toggle': {
-                    'rich_text': [{'type': 'text', 'text': {'content': '📖 実行結果を表示'}}],
-                    'color': 'purple_background'
-                }
-            }
+            toggle_block = _rich_text_block('toggle', '📖 実行結果を表示', color='purple_background')
             
             # 子要素がある場合のみchildrenを追加
             if result_children:
@@ -176,8 +352,11 @@ class NotionBlockConverter:
         result_start = -1
         
         for i, line in enumerate(lines):
+            # 見出しのパターンはすべて '#' で始まるため、それ以外の行では正規表現を使わない
+            is_heading = line.startswith('#')
+            
             # 実行記録のヘッダー
-            if match := re.match(r'^##\s*実行記録:\s*(.+)$', line):
+            if is_heading and (match := _EXEC_HEADER_RE.match(line)):
                 sections['execution_header'] = f"実行記録: {match.group(1)}"
                 current_section = 'metadata'
                 continue
@@ -185,20 +364,23 @@ class NotionBlockConverter:
             # メタデータ（接続先、プロンプトファイル）
             if current_section == 'metadata' and '**' in line:
                 # **を除去してクリーンな形式に
-                clean_line = re.sub(r'\*\*([^:]+):\*\*\s*(.+)', r'\1: \2', line)
+                clean_line = _METADATA_LINE_RE.sub(r'\1: \2', line)
                 if clean_line != line:  # 変換が成功した場合のみ追加
                     metadata_lines.append(clean_line)
                 continue
             
+            if not is_heading:
+                continue
+            
             # プロンプトセクションの開始
-            if re.match(r'^###\s+プロンプト', line):
+            if _PROMPT_HEADER_RE.match(line):
                 sections['prompt_title'] = 'プロンプト'
                 prompt_start = i + 1
                 current_section = 'prompt'
                 continue
             
             # 結果セクションの開始
-            if re.match(r'^###\s+結果', line):
+            if _RESULT_HEADER_RE.match(line):
                 sections['result_title'] = '結果'
                 result_start = i + 1
                 current_section = 'result'
@@ -224,7 +406,7 @@ class NotionBlockConverter:
                     clean_line = line[1:].lstrip()
                     if clean_line or line == '>':  # 空行も保持
                         clean_prompt_lines.append(clean_line)
-                elif line.strip() and not line.startswith('#'):
+                elif not _is_blank(line) and not line.startswith('#'):
                     clean_prompt_lines.append(line)
             
             sections['prompt_content'] = '\n'.join(clean_prompt_lines).strip()
@@ -239,7 +421,7 @@ class NotionBlockConverter:
                     result_end = i
                     break
                 # 新しい実行記録セクションを検出（別のremote-claude実行）
-                if re.match(r'^##\s+実行記録:', lines[i]) and i > result_start:
+                if lines[i].startswith('##') and _EXEC_SECTION_RE.match(lines[i]) and i > result_start:
                     result_end = i
                     break
                 # 注意: 結果内の ## は含める（Claude の応答の一部なので）
@@ -270,142 +452,102 @@ class NotionBlockConverter:
         
         return sections
     
-    def _create_result_blocks(self, result_content: str, md_dir: Path) -> List[Dict[str, Any]]:
-        """結果内容からNotionブロックを作成（トグル内用）"""
+    def _create_result_blocks(self, result_content: str, md_dir: Path) -> Iterator[Dict[str, Any]]:
+        """結果内容からNotionブロックを順に生成する（トグル内用）"""
         if not result_content:
             logging.warning("結果内容が空です")
-            return []
-        
-        blocks = []
+            return
         
         logging.info(f"結果内容をMarkdownとして処理: {result_content[:100]}...")
         
+        # 1行の地の文だけなら段落1つにしかならないので、Markdownとして解析しない
+        # （前後の空白は除かれている前提。改行・NUL文字を含むものやブロック要素になりうるものは解析に回す）
+        if (result_content[0] not in _BLOCK_START_CHARS and '\n' not in result_content
+                and '\r' not in result_content and '\0' not in result_content):
+            yield from self._toggle_paragraph_blocks(result_content)
+            return
+        
         # 結果の内容を処理
         # マークダウンの各要素を適切に変換
         tokens = self.md.parse(result_content)
         
-        logging.info(f"トークン数: {len(tokens)}")
+        token_count = len(tokens)
+        logging.info(f"トークン数: {token_count}")
         
+        get_handler = self._toggle_handlers.get
         i = 0
-        while i < len(tokens):
-            token = tokens[i]
-            t = token.type
+        while i < token_count:
+            t = tokens[i].type
             
-            logging.debug(f"トークン {i}: {t}")
+            logging.debug("トークン %d: %s", i, t)
             
-            if t == 'heading_open':
-                i = self._process_heading_for_toggle(tokens, i, blocks)
-            elif t in ('bullet_list_open', 'ordered_list_open'):
-                i = self._process_list_for_toggle(tokens, i, blocks)
-            elif t == 'paragraph_open':
-                i = self._process_paragraph_for_toggle(tokens, i, blocks, md_dir)
-            elif t == 'fence':
-                i = self._process_code_block(tokens, i, blocks)
-            elif t == 'blockquote_open':
-                i = self._process_blockquote_for_toggle(tokens, i, blocks)
-            elif t == 'hr':
-                blocks.append({'object': 'block', 'type': 'divider', 'divider': {}})
-                i += 1
-            elif t == 'inline':
-                # インライン要素の処理
-                txt = token.content.strip()
-                if txt:
-                    blocks.append({
-                        'object': 'block',
-                        'type': 'paragraph',
-                        'paragraph': {'rich_text': [{'type': 'text', 'text': {'content': txt}}]}
-                    })
-                i += 1
+            handler = get_handler(t)
+            if handler:
+                i = yield from handler(tokens, i, md_dir)
             else:
                 i += 1
-        
-        logging.info(f"生成されたブロック数: {len(blocks)}")
-        
-        return blocks
     
-    def _process_heading_for_toggle(self, tokens, i: int, blocks: List[Dict]) -> int:
+    def _process_inline_for_toggle(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
+        """トグル内のインライン要素を処理"""
+        txt = tokens[i].content.strip()
+        if txt:
+            yield _paragraph(txt)
+        return i + 1
+    
+    def _process_heading_for_toggle(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
         """トグル内の見出しを処理"""
         token = tokens[i]
         lvl = int(token.tag[1])
         content = tokens[i+1].content
         
-        # トグル内では見出しレベルを調整しない（元のレベルを維持）
-        blk = f"heading_{min(lvl, 3)}"  # 最大h3まで
-        
-        blocks.append({
-            'object': 'block',
-            'type': blk,
-            blk: {'rich_text': [{'type': 'text', 'text': {'content': content}}]}
-        })
+        # トグル内では見出しレベルを調整しない（元のレベルを維持、最大h3まで）
+        yield _heading(lvl, content)
         
-        logging.debug(f"見出しを追加: {content}")
+        logging.debug("見出しを追加: %s", content)
         
         return i + 3
     
-    def _process_list_for_toggle(self, tokens, i: int, blocks: List[Dict]) -> int:
+    def _process_list_for_toggle(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
         """トグル内のリストを処理"""
-        list_type = 'numbered_list_item' if tokens[i].type == 'ordered_list_open' else 'bulleted_list_item'
-        i += 1
+        items, i = _scan_list_items(tokens, i)
         
-        while i < len(tokens) and tokens[i].type not in ('bullet_list_close', 'ordered_list_close'):
-            if tokens[i].type == 'list_item_open':
-                # リストアイテムの内容を取得
-                content_idx = i + 2
-                if content_idx < len(tokens):
-                    txt = tokens[content_idx].content
-                    
-                    blocks.append({
-                        'object': 'block',
-                        'type': list_type,
-                        list_type: {'rich_text': [{'type': 'text', 'text': {'content': txt}}]}
-                    })
-                    
-                    logging.debug(f"リストアイテムを追加: {txt[:50]}...")
-                
-                # 次のリストアイテムへ
-                i += 5
-            else:
-                i += 1
+        for list_type, txt in items:
+            yield _rich_text_block(list_type, txt)
+            
+            logging.debug("リストアイテムを追加: %.50s...", txt)
         
-        return i + 1
+        return i
     
-    def _process_paragraph_for_toggle(self, tokens, i: int, blocks: List[Dict], md_dir: Path) -> int:
+    def _process_paragraph_for_toggle(self, tokens, i: int, md_dir: Path) -> Generator[Dict[str, Any], None, int]:
         """トグル内の段落を処理"""
         if i + 1 < len(tokens):
             txt = tokens[i+1].content.strip()
             if txt:
-                # インライン数式のパターン
-                inline_math_pattern = r'\$([^$\n]+)\$'
-                
-                # ブロック数式のパターンをチェック
-                block_math_pattern = r'\$\$\s*(.*?)\s*\$\$'
-                block_math_match = re.search(block_math_pattern, txt, re.DOTALL)
-                
-                if block_math_match:
-                    math_content = block_math_match.group(1).strip()
-                    blocks.append({
-                        'object': 'block',
-                        'type': 'equation',
-                        'equation': {'expression': math_content}
-                    })
-                    logging.debug(f"数式を追加: {math_content[:30]}...")
-                else:
-                    # インライン数式をチェック
-                    inline_math_matches = list(re.finditer(inline_math_pattern, txt))
-                    if inline_math_matches:
-                        self._process_inline_math(txt, inline_math_matches, blocks)
-                    else:
-                        # 通常のテキスト処理
-                        blocks.append({
-                            'object': 'block',
-                            'type': 'paragraph',
-                            'paragraph': {'rich_text': [{'type': 'text', 'text': {'content': txt}}]}
-                        })
-                        logging.debug(f"段落を追加: {txt[:50]}...")
+                yield from self._toggle_paragraph_blocks(txt)
         
         return i + 2
     
-    def _process_blockquote_for_toggle(self, tokens, i: int, blocks: List[Dict]) -> int:
+    def _toggle_paragraph_blocks(self, txt: str) -> Iterator[Dict[str, Any]]:
+        """トグル内の段落の内容からブロックを生成する（ブロック数式・インライン数式を含む）"""
+        # ブロック数式のパターンをチェック（'$' を含まない段落は正規表現を使わない）
+        has_dollar = '$' in txt
+        block_math_match = _BLOCK_MATH_RE.search(txt) if has_dollar else None
+        
+        if block_math_match:
+            math_content = block_math_match.group(1).strip()
+            yield _equation(math_content)
+            logging.debug("数式を追加: %.30s...", math_content)
+        else:
+            # インライン数式をチェック
+            inline_math_parts = _INLINE_MATH_RE.split(txt) if has_dollar else None
+            if inline_math_parts and len(inline_math_parts) > 1:
+                yield from self._process_inline_math(inline_math_parts)
+            else:
+                # 通常のテキスト処理
+                yield _paragraph(txt)
+                logging.debug("段落を追加: %.50s...", txt)
+    
+    def _process_blockquote_for_toggle(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
         """トグル内の引用を処理"""
         i += 1
         content_lines = []
@@ -419,269 +561,211 @@ class NotionBlockConverter:
         
         if content_lines:
             content = '\n'.join(content_lines)
-            blocks.append({
-                'object': 'block',
-                'type': 'quote',
-                'quote': {'rich_text': [{'type': 'text', 'text': {'content': content}}]}
-            })
+            yield _quote(content)
         
         return i + 1
     
-    def _process_code_block(self, tokens, i: int, blocks: List[Dict]) -> int:
+    def _process_code_block(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
         """コードブロックを処理"""
         token = tokens[i]
         language = token.info or 'plain text'
         content = token.content
         
-        # Notion APIで無効な言語名を変換
-        language_mapping = {
-            'text': 'plain text',
-            'txt': 'plain text',
-            'plaintext': 'plain text',
-            'sh': 'shell',
-            'bash': 'shell',
-            'zsh': 'shell',
-            'js': 'javascript',
-            'ts': 'typescript',
-            'py': 'python',
-            'rb': 'ruby',
-            'yml': 'yaml',
-            'md': 'markdown',
-            '': 'plain text'
-        }
-        
-        # 言語名の正規化
+        # 言語名の正規化（Notion APIで無効な言語名を変換）
         normalized_language = language.lower().strip()
-        if normalized_language in language_mapping:
-            language = language_mapping[normalized_language]
-        elif normalized_language == '':
-            language = 'plain text'
+        language = _LANGUAGE_MAPPING.get(normalized_language, language)
         
         # 数式として処理するかチェック
-        if normalized_language in ('math', 'latex', 'tex'):
-            blocks.append({
-                'object': 'block',
-                'type': 'equation',
-                'equation': {'expression': content}
-            })
+        if normalized_language in MATH_LANGUAGES:
+            yield _equation(content)
         else:
-            blocks.append({
-                'object': 'block',
-                'type': 'code',
-                'code': {
-                    'language': language,
-                    'rich_text': [{'type': 'text', 'text': {'content': content}}]
-                }
-            })
+            yield _code(language, content)
         
         return i + 1
     
-    def _process_inline_math(self, text: str, matches, blocks: List[Dict]):
-        """インライン数式を含むテキストを処理"""
-        if not matches:
-            blocks.append({
-                'object': 'block',
-                'type': 'paragraph',
-                'paragraph': {'rich_text': [{'type': 'text', 'text': {'content': text}}]}
-            })
-            return
-        
-        rich_text = []
-        last_end = 0
+    def _process_inline_math(self, parts: List[str]) -> Iterator[Dict[str, Any]]:
+        """インライン数式を含むテキストを処理（parts は _INLINE_MATH_RE.split の結果）"""
+        # 偶数番目は数式の前後のテキスト、奇数番目は数式（空のテキストは含めない）
+        rich_text = [
+            _inline_equation(part) if k % 2 else _text(part)
+            for k, part in enumerate(parts) if part
+        ]
         
-        for match in matches:
-            # 数式前のテキスト
-            if match.start() > last_end:
-                rich_text.append({
-                    'type': 'text',
-                    'text': {'content': text[last_end:match.start()]}
-                })
-            
-            # 数式
-            math_content = match.group(1)
-            rich_text.append({
-                'type': 'equation',
-                'equation': {'expression': math_content}
-            })
-            
-            last_end = match.end()
-        
-        # 残りのテキスト
-        if last_end < len(text):
-            rich_text.append({
-                'type': 'text',
-                'text': {'content': text[last_end:]}
-            })
-        
-        blocks.append({
-            'object': 'block',
-            'type': 'paragraph',
-            'paragraph': {'rich_text': rich_text}
-        })
+        yield {'object': 'block', 'type': 'paragraph', 'paragraph': {'rich_text': rich_text}}
     
-    def _process_callouts(self, md_text: str) -> str:
-        """Obsidianスタイルのコールアウトを処理"""
-        lines = md_text.split('\n')
-        processed_lines = []
-        i = 0
-        
-        while i < len(lines):
-            line = lines[i]
-            
-            # コールアウトの開始を検出
-            callout_match = re.match(r'>\s*\[!(\w+)\](?:\s*(.*))?', line)
-            if callout_match:
-                callout_type = callout_match.group(1).upper()
-                callout_title = callout_match.group(2) or callout_type.title()
-                
-                # コールアウトの内容を収集
-                callout_content = []
-                i += 1
-                
-                while i < len(lines) and (lines[i].startswith('>') or lines[i].strip() == ''):
-                    content_line = lines[i]
-                    if content_line.startswith('>'):
-                        content_line = content_line[1:].lstrip()
-                    callout_content.append(content_line)
-                    i += 1
-                
-                # コールアウトをMarkdown引用に変換
-                emoji = self.parser.CALLOUT_TYPES.get(callout_type, '📝')
-                processed_lines.append(f'> **{emoji} {callout_title}**')
-                processed_lines.append('>')
-                for content in callout_content:
-                    if content.strip():
-                        processed_lines.append(f'> {content}')
-                    else:
-                        processed_lines.append('>')
-                
-                continue
-            
-            processed_lines.append(line)
-            i += 1
+    def _render_callout(self, callout_match) -> str:
+        """Obsidianスタイルのコールアウト1件をMarkdown引用に変換する"""
+        callout_type = callout_match.group('callout_type').upper()
+        callout_title = callout_match.group('callout_title') or callout_type.title()
+        
+        emoji = CALLOUT_TYPES.get(callout_type, '📝')
+        processed_lines = [f'> **{emoji} {callout_title}**', '>']
+        append = processed_lines.append
+        
+        # 本文は先頭の改行を除いて分割する（本文がなければ分割しない）
+        callout_body = callout_match.group('callout_body')
+        for content in (callout_body[1:].split('\n') if callout_body else ()):
+            if content.startswith('>'):
+                content = content[1:].lstrip()
+            append('>' if _is_blank(content) else '> ' + content)
         
         return '\n'.join(processed_lines)
     
-    def _process_text_with_block_math(self, md_text: str, md_dir: Path, blocks: List[Dict]):
-        """テキストを処理してブロック数式を検出"""
-        # ブロック数式のパターン
-        block_math_pattern = r'\$\$\s*(.*?)\s*\$\$'
+    def _process_text_with_block_math(self, md_text: str, md_dir: Path) -> Iterator[Dict[str, Any]]:
+        """テキストを一度だけ走査し、コールアウトとObsidianリンクの変換、ブロック数式の検出を行う"""
+        # コールアウトもブロック数式もリンクも含まなければそのまま処理する
+        if '$$' not in md_text and '[!' not in md_text and '[[' not in md_text:
+            if not _is_blank(md_text):
+                yield from self._process_regular_markdown(md_text, md_dir)
+            return
         
-        # テキストを分割
-        parts = re.split(block_math_pattern, md_text, flags=re.DOTALL)
+        # コールアウトとリンクはその場で置き換え、ブロック数式は目印に置き換えて取り出す
+        equations: List[str] = []
         
-        for i, part in enumerate(parts):
-            if not part.strip():
-                continue
-                
-            if i % 2 == 1:  # 数式部分
-                blocks.append({
-                    'object': 'block',
-                    'type': 'equation',
-                    'equation': {'expression': part.strip()}
-                })
-            else:  # 通常のMarkdown部分
-                # 通常のMarkdown処理
-                tokens = self.md.parse(part)
-                j = 0
-                while j < len(tokens):
-                    token = tokens[j]
-                    t = token.type
-                    
-                    if t == 'heading_open':
-                        j = self._process_heading(tokens, j, blocks)
-                    elif t in ('bullet_list_open', 'ordered_list_open'):
-                        j = self._process_list(tokens, j, blocks)
-                    elif t == 'paragraph_open':
-                        j = self._process_paragraph(tokens, j, blocks, md_dir)
-                    elif t == 'fence':
-                        j = self._process_code_block(tokens, j, blocks)
-                    elif t == 'blockquote_open':
-                        j = self._process_blockquote(tokens, j, blocks)
-                    elif t == 'hr':
-                        blocks.append({'object': 'block', 'type': 'divider', 'divider': {}})
-                        j += 1
-                    else:
-                        j += 1
+        def add_equation(expression: str) -> str:
+            equations.append(expression)
+            return _MATH_PLACEHOLDER
+        
+        def replace(match) -> str:
+            kind = match.lastgroup
+            if kind == 'link':
+                return match.group('link')
+            if kind == 'math':
+                return add_equation(_strip_obsidian_links(match.group('math')))
+            
+            callout_text = _strip_obsidian_links(self._render_callout(match))
+            if '$$' not in callout_text:
+                return callout_text
+            # コールアウト内のブロック数式も数式ブロックとして切り出す
+            return _BLOCK_MATH_RE.sub(lambda m: add_equation(m.group(1)), callout_text)
+        
+        # 目印と衝突しないよう、NUL文字はmarkdown-itと同じくU+FFFDに置き換えておく
+        if _MATH_PLACEHOLDER in md_text:
+            md_text = md_text.replace(_MATH_PLACEHOLDER, '\ufffd')
+        
+        text = _MARKDOWN_SCAN_RE.sub(replace, md_text)
+        
+        # 数式の間にある通常のMarkdown部分は、処理する時点で目印の位置から切り出す
+        # （ブロック数の上限で打ち切られた場合、残りの部分は切り出さない）
+        start = 0
+        for expression in equations:
+            end = text.index(_MATH_PLACEHOLDER, start)
+            part = text[start:end]
+            if not _is_blank(part):
+                yield from self._process_regular_markdown(part, md_dir)
+            yield from self._block_equation(expression)
+            start = end + 1
+        
+        part = text[start:]
+        if not _is_blank(part):
+            yield from self._process_regular_markdown(part, md_dir)
+    
+    def _block_equation(self, expression: str) -> Iterator[Dict[str, Any]]:
+        """ブロック数式を生成する（空の数式は無視）"""
+        expression = expression.strip()
+        if expression:
+            yield _equation(expression)
+    
+    def _process_regular_markdown(self, md_text: str, md_dir: Path) -> Iterator[Dict[str, Any]]:
+        """通常のMarkdown部分を処理"""
+        tokens = self.md.parse(md_text)
+        token_count = len(tokens)
+        get_handler = self._block_handlers.get
+        j = 0
+        while j < token_count:
+            handler = get_handler(tokens[j].type)
+            if handler:
+                j = yield from handler(tokens, j, md_dir)
+            else:
+                j += 1
+    
+    def _process_divider(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
+        """区切り線を処理"""
+        yield _divider()
+        return i + 1
     
-    def _process_heading(self, tokens, i: int, blocks: List[Dict]) -> int:
+    def _process_heading(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
         """見出しを処理"""
         token = tokens[i]
         level = int(token.tag[1])
         content = tokens[i+1].content
         
-        heading_type = f"heading_{min(level, 3)}"
-        blocks.append({
-            'object': 'block',
-            'type': heading_type,
-            heading_type: {'rich_text': [{'type': 'text', 'text': {'content': content}}]}
-        })
+        yield _heading(level, content)
         
         return i + 3
     
-    def _process_list(self, tokens, i: int, blocks: List[Dict]) -> int:
+    def _process_list(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
         """リストを処理"""
-        list_type = 'numbered_list_item' if tokens[i].type == 'ordered_list_open' else 'bulleted_list_item'
-        i += 1
-        
-        while i < len(tokens) and tokens[i].type not in ('bullet_list_close', 'ordered_list_close'):
-            if tokens[i].type == 'list_item_open':
-                content_idx = i + 2
-                if content_idx < len(tokens):
-                    txt = tokens[content_idx].content
-                    blocks.append({
-                        'object': 'block',
-                        'type': list_type,
-                        list_type: {'rich_text': [{'type': 'text', 'text': {'content': txt}}]}
-                    })
-                i += 5
-            else:
-                i += 1
-        
-        return i + 1
+        items, i = _scan_list_items(tokens, i)
+        for list_type, txt in items:
+            yield _rich_text_block(list_type, txt)
+        return i
     
-    def _process_paragraph(self, tokens, i: int, blocks: List[Dict], md_dir: Path) -> int:
+    def _process_paragraph(self, tokens, i: int, md_dir: Path) -> Generator[Dict[str, Any], None, int]:
         """段落を処理"""
         if i + 1 < len(tokens):
             txt = tokens[i+1].content.strip()
             if txt:
                 # 画像の処理
-                img_pattern = r'!\[([^\]]*)\]\(([^)]+)\)'
-                img_match = re.search(img_pattern, txt)
+                img_match = _IMAGE_RE.search(txt) if '![' in txt else None
                 
                 if img_match:
-                    alt_text = img_match.group(1)
                     img_path = img_match.group(2)
+                    image_block = _image(img_path)
                     
-                    # 相対パスを絶対パスに変換
+                    # 相対パスを絶対パスに変換し、アップロードは後でまとめて行う
                     if not img_path.startswith(('http://', 'https://')):
                         full_img_path = md_dir / img_path
-                        img_url = self.image_uploader.get_image_url(full_img_path)
-                    else:
-                        img_url = img_path
+                        self._pending_images.append((image_block, full_img_path))
                     
-                    blocks.append({
-                        'object': 'block',
-                        'type': 'image',
-                        'image': {'external': {'url': img_url}}
-                    })
+                    yield image_block
                 else:
-                    # インライン数式のパターン
-                    inline_math_pattern = r'\$([^$\n]+)\$'
-                    inline_math_matches = list(re.finditer(inline_math_pattern, txt))
+                    # '$' を含まない段落は正規表現を使わない
+                    inline_math_parts = _INLINE_MATH_RE.split(txt) if '$' in txt else None
                     
-                    if inline_math_matches:
-                        self._process_inline_math(txt, inline_math_matches, blocks)
+                    if inline_math_parts and len(inline_math_parts) > 1:
+                        yield from self._process_inline_math(inline_math_parts)
                     else:
-                        blocks.append({
-                            'object': 'block',
-                            'type': 'paragraph',
-                            'paragraph': {'rich_text': [{'type': 'text', 'text': {'content': txt}}]}
-                        })
+                        yield _paragraph(txt)
         
         return i + 2
     
-    def _process_blockquote(self, tokens, i: int, blocks: List[Dict]) -> int:
+    def _resolve_pending_images(self):
+        """URL解決待ちの画像をアップロードしてブロックにURLを設定する"""
+        pending = self._pending_images
+        self._pending_images = []
+        if not pending:
+            return
+        
+        # 同じパスは一度だけ処理する（dictのキーで重複除去と処理済み判定を兼ねる）
+        urls = self._image_urls
+        new_paths = [path for path in dict.fromkeys(path for _, path in pending) if path not in urls]
+        
+        if new_paths:
+            # 別のパスで参照された同じファイル（./a.png と img/../a.png など）も一度だけアップロードする
+            file_urls = self._image_file_urls
+            path_keys = {path: _image_file_key(path) for path in new_paths}
+            uploads = {}
+            for path, key in path_keys.items():
+                if key not in file_urls:
+                    uploads.setdefault(key, path)
+            
+            if len(uploads) == 1:
+                (key, path), = uploads.items()
+                file_urls[key] = self.image_uploader.get_image_url(path)
+            elif uploads:
+                logging.info(f"{len(uploads)}個の画像を並列にアップロードします")
+                workers = min(IMAGE_UPLOAD_WORKERS, len(uploads))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    file_urls.update(zip(uploads, executor.map(self.image_uploader.get_image_url, uploads.values())))
+            
+            for path, key in path_keys.items():
+                urls[path] = file_urls[key]
+        
+        for image_block, path in pending:
+            image_block['image']['external']['url'] = urls[path]
+    
+    def _process_blockquote(self, tokens, i: int) -> Generator[Dict[str, Any], None, int]:
         """引用ブロックを処理"""
         i += 1
         content_lines = []
@@ -695,41 +779,34 @@ class NotionBlockConverter:
         
         if content_lines:
             content = '\n'.join(content_lines)
-            blocks.append({
-                'object': 'block',
-                'type': 'quote',
-                'quote': {'rich_text': [{'type': 'text', 'text': {'content': content}}]}
-            })
+            yield _quote(content)
         
         return i + 1
     
-    def _validate_blocks(self, blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-        """ブロックを検証して制限に準拠させる"""
+    def _validate_blocks(self, blocks: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """ブロックを検証して制限に準拠させる（上限に達した時点で以降のブロックは取り出さない）"""
         validated_blocks = []
+        max_blocks = self.config.max_blocks_per_page
+        validate_rich_text_length = self._validate_rich_text_length
         
         for block in blocks:
             # ブロック数の制限チェック
-            if len(validated_blocks) >= self.config.max_blocks_per_page:
-                logging.warning(f"ブロック数が制限({self.config.max_blocks_per_page})に達しました")
+            if len(validated_blocks) >= max_blocks:
+                logging.warning(f"ブロック数が制限({max_blocks})に達しました")
                 break
             
             # rich_textの長さ制限チェック
-            self._validate_rich_text_length(block)
+            validate_rich_text_length(block)
             
             # トグルブロックの子要素も検証
             if block.get('type') == 'toggle' and 'toggle' in block and 'children' in block['toggle']:
                 children = block['toggle']['children']
-                validated_children = []
+                if len(children) > MAX_TOGGLE_CHILDREN:
+                    logging.warning("トグル内の子要素が制限に達しました")
+                    del children[MAX_TOGGLE_CHILDREN:]
                 
                 for child in children:
-                    if len(validated_children) < 50:  # トグル内の子要素制限
-                        self._validate_rich_text_length(child)
-                        validated_children.append(child)
-                    else:
-                        logging.warning("トグル内の子要素が制限に達しました")
-                        break
-                
-                block['toggle']['children'] = validated_children
+                    validate_rich_text_length(child)
             
             validated_blocks.append(block)
         
@@ -737,36 +814,27 @@ class NotionBlockConverter:
     
     def _validate_rich_text_length(self, block: Dict[str, Any]):
         """rich_textの長さを制限内に収める"""
-        if 'paragraph' in block:
-            self._truncate_rich_text(block['paragraph'])
-        elif 'heading_1' in block:
-            self._truncate_rich_text(block['heading_1'])
-        elif 'heading_2' in block:
-            self._truncate_rich_text(block['heading_2'])
-        elif 'heading_3' in block:
-            self._truncate_rich_text(block['heading_3'])
-        elif 'quote' in block:
-            self._truncate_rich_text(block['quote'])
-        elif 'bulleted_list_item' in block:
-            self._truncate_rich_text(block['bulleted_list_item'])
-        elif 'numbered_list_item' in block:
-            self._truncate_rich_text(block['numbered_list_item'])
-        elif 'toggle' in block:
-            self._truncate_rich_text(block['toggle'])
-        elif 'callout' in block:
-            self._truncate_rich_text(block['callout'])
+        block_type = block.get('type')
+        if block_type in _RICH_TEXT_BLOCK_TYPES and block_type in block:
+            self._truncate_rich_text(block[block_type])
     
     def _truncate_rich_text(self, block_content: Dict[str, Any]):
         """rich_textを制限内に切り詰める"""
         if 'rich_text' in block_content:
             rich_text_list = block_content['rich_text']
+            max_length = self.config.max_rich_text_length
+            
+            # ほとんどのブロックは制限内に収まるため、その場合はリストを作り直さない
+            if sum(len(rt['text']['content']) for rt in rich_text_list if rt.get('type') == 'text') <= max_length:
+                return
+            
             total_length = 0
             truncated_rich_text = []
             
             for rt in rich_text_list:
                 if rt.get('type') == 'text':
                     text_content = rt['text']['content']
-                    remaining_length = self.config.max_rich_text_length - total_length
+                    remaining_length = max_length - total_length
                     
                     if len(text_content) <= remaining_length:
                         truncated_rich_text.append(rt)
@@ -780,4 +848,4 @@ class NotionBlockConverter:
                 else:
                     truncated_rich_text.append(rt)
             
-            block_content['rich_text'] = truncated_rich_text
\ No newline at end of file
+            block_content['rich_text'] = truncated_rich_text
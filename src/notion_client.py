@@ -3,7 +3,6 @@ Notionクライアント機能モジュール
 """
 
 import logging
-import traceback
 from typing import List, Dict, Any, Optional
 
 from notion_client import Client, APIResponseError
@@ -11,23 +10,39 @@ from notion_client import Client, APIResponseError
 from .config import Config
 
 
+# Notion APIで作成できるブロックの種類
+VALID_BLOCK_TYPES = frozenset({
+    'paragraph', 'heading_1', 'heading_2', 'heading_3',
+    'bulleted_list_item', 'numbered_list_item', 'to_do',
+    'toggle', 'child_page', 'child_database', 'embed',
+    'image', 'video', 'file', 'pdf', 'bookmark',
+    'callout', 'quote', 'divider', 'table_of_contents',
+    'column', 'column_list', 'link_preview', 'synced_block',
+    'template', 'link_to_page', 'table', 'table_row',
+    'code', 'equation'
+})
+
 class NotionClientWrapper:
     """Notion APIクライアントのラッパークラス"""
     
     def __init__(self, config: Config):
         self.config = config
         try:
-            self.client = Client(auth=config.notion_token)
+            # Clientは内部のHTTP接続をKeep-Aliveで使い回すため、ページ作成ごとに作り直さない
+            # （APIのバージョンはnotion-clientの既定値に任せず固定する）
+            # （レート制限（HTTP 429）はClientがRetry-Afterに従って再試行するため、ここでは再試行しない）
+            self.client = Client(auth=config.notion_token, notion_version=config.notion_version)
         except Exception as e:
-            logging.error(f"Notionクライアントの初期化に失敗しました: {e}")
-            traceback.print_exc()
+            logging.exception(f"Notionクライアントの初期化に失敗しました: {e}")
             raise
+        
+        self._pages_create = self.client.pages.create
+        # 親を指定しない場合の作成先（リクエストの本文として読まれるだけなので使い回す）
+        self._default_parent = {'database_id': config.database_id}
     
-    def create_page(self, title: str, abstract: str, blocks: List[Dict[str, Any]], parent_id: Optional[str] = None) -> Optional[Dict]:
-        """Notionページを作成する"""
-        parent = {'database_id': self.config.database_id}
-        if parent_id:
-            parent = {'page_id': parent_id}
+    def create_page(self, title: str, abstract: str, blocks: List[Dict[str, Any]], parent_id: Optional[str] = None) -> Dict:
+        """Notionページを作成する（作成できなかった場合は APIResponseError をそのまま送出する）"""
+        parent = {'page_id': parent_id} if parent_id else self._default_parent
         
         # ページプロパティの設定
         page_props = self._build_page_properties(title, abstract)
@@ -36,33 +51,24 @@ class NotionClientWrapper:
         processed_blocks = self._preprocess_blocks(blocks)
         
         try:
-            new_page = self.client.pages.create(
+            return self._pages_create(
                 parent=parent,
                 properties=page_props,
                 children=processed_blocks
             )
-            return new_page
         except APIResponseError as err:
-            logging.error(f"Notion API エラー: {err}")
-            
-            # エラー処理とフォールバック
-            if 'callout' in str(err):
-                logging.info("calloutブロックをquoteブロックに変換して再試行します")
-                fallback_blocks = self._convert_callouts_to_quotes(processed_blocks)
-                try:
-                    new_page = self.client.pages.create(
-                        parent=parent,
-                        properties=page_props,
-                        children=fallback_blocks
-                    )
-                    return new_page
-                except APIResponseError as err2:
-                    logging.error(f"再試行も失敗しました: {err2}")
-                    traceback.print_exc()
-                    return None
-            
-            traceback.print_exc()
-            return None
+            # 失敗のログは呼び出し側で一度だけ出す
+            if 'callout' not in str(err):
+                raise
+            logging.info(f"calloutブロックが受け付けられなかったため、quoteブロックに変換して再試行します: {err}")
+        
+        # calloutブロックが受け付けられなかった場合のフォールバック
+        fallback_blocks = self._convert_callouts_to_quotes(processed_blocks)
+        return self._pages_create(
+            parent=parent,
+            properties=page_props,
+            children=fallback_blocks
+        )
     
     def _build_page_properties(self, title: str, abstract: str) -> Dict[str, Any]:
         """ページプロパティを構築する"""
@@ -81,14 +87,8 @@ class NotionClientWrapper:
     
     def _preprocess_blocks(self, blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """ブロックの前処理を行う（トグル内のchildrenも処理）"""
-        processed = []
-        
-        for block in blocks:
-            processed_block = self._process_single_block(block)
-            if processed_block:
-                processed.append(processed_block)
-        
-        return processed
+        process_single_block = self._process_single_block
+        return [block for block in map(process_single_block, blocks) if block]
     
     def _process_single_block(self, block: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """単一ブロックを処理（再帰的にchildrenも処理）"""
@@ -111,19 +111,7 @@ class NotionClientWrapper:
     
     def _is_valid_block(self, block: Dict[str, Any]) -> bool:
         """ブロックが有効かどうかを確認する"""
-        valid_types = [
-            'paragraph', 'heading_1', 'heading_2', 'heading_3',
-            'bulleted_list_item', 'numbered_list_item', 'to_do',
-            'toggle', 'child_page', 'child_database', 'embed',
-            'image', 'video', 'file', 'pdf', 'bookmark',
-            'callout', 'quote', 'divider', 'table_of_contents',
-            'column', 'column_list', 'link_preview', 'synced_block',
-            'template', 'link_to_page', 'table', 'table_row',
-            'code', 'equation'
-        ]
-        
-        block_type = block.get('type')
-        return block_type in valid_types
+        return block.get('type') in VALID_BLOCK_TYPES
     
     def _convert_callouts_to_quotes(self, blocks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
         """calloutブロックをquoteブロックに変換する（フォールバック用）"""
@@ -2,15 +2,64 @@
 Notionアップローダーメインモジュール
 """
 
+import os
+import itertools
 import logging
 import re
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
 
 from .config import Config
 from .markdown_parser import MarkdownParser
-from .notion_block_converter import NotionBlockConverter
-from .notion_client import NotionClientWrapper
+from .notion_block_converter import NotionBlockConverter, _rich_text_block
+from .notion_client import NotionClientWrapper, APIResponseError
+
+
+# ディレクトリ情報のログで画像として扱う拡張子
+_IMG_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.gif', '.svg'})
+
+# ファイルタイプ判定
+# （正規表現の前に、必ず含まれる固定文字列の有無を安価に確認する）
+_REMOTE_CLAUDE_MARKER = '## 実行記録:'
+_REMOTE_CLAUDE_RE = re.compile(r'## 実行記録:\s*\d{4}-\d{2}-\d{2}')
+_OBSIDIAN_RE = re.compile(r'\[\[.*?\]\]|>\s*\[!.*?\]')
+# 判定に使う先頭部分の文字数（目印は通常ファイルの先頭付近にある）
+FILE_TYPE_SCAN_CHARS = 64 * 1024
+
+# remote-claude形式のタイトル・要約の抽出
+_TITLE_PROMPT_RE = re.compile(r'>\s*(.{1,50})')
+_ABSTRACT_PROMPT_RE = re.compile(r'### 💬 プロンプト.*?\n>\s*(.{1,100})', re.DOTALL)
+_ABSTRACT_RESULT_RE = re.compile(r'### ✨ 結果\s*\n(.{1,100})', re.DOTALL)
+# 抜粋から除去する文字（空白に置き換える）
+_PROMPT_CLEAN_TABLE = str.maketrans('>\n\r\t', '    ')
+_RESULT_CLEAN_TABLE = str.maketrans('#>\n\r\t', '     ')
+
+# remote-claude形式のメタデータとして表示するフロントマターのキーと見出し（表示順）
+METADATA_FIELDS = (
+    ('execution_time', '⏰ 実行時刻'),
+    ('connection_host', '🖥️ 接続先'),
+    ('prompt_file', '📝 プロンプトファイル'),
+)
+
+
+@dataclass(frozen=True)
+class RemoteClaudePreviews:
+    """remote-claude形式の本文から抽出した抜粋（改行や特殊文字は除去済み、見つからなければNone）"""
+    title_prompt: Optional[str]
+    prompt: Optional[str]
+    result: Optional[str]
+
+
+def _metadata_item(content: str) -> Dict[str, Any]:
+    """メタデータ1項目分の箇条書きブロックを作成する"""
+    return _rich_text_block('bulleted_list_item', content, color='gray_background')
+
+
+def _iter_chunks(blocks: Iterable[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    """ブロックを先頭から size 個ずつのリストにして順に返す（末尾の空リストは返さない）"""
+    blocks_iter = iter(blocks)
+    return iter(lambda: list(itertools.islice(blocks_iter, size)), [])
 
 
 class NotionUploader:
@@ -26,26 +75,30 @@ class NotionUploader:
         """Markdownファイルをアップロードする"""
         logging.info(f"アップロード開始: {md_path}")
         
+        # 画像の基準ディレクトリ（resolve() はシンボリックリンクを辿るため一度だけ呼ぶ）
+        md_dir = md_path.parent.resolve()
+        
         # ディレクトリ情報をログ出力
-        self._log_directory_info(md_path)
+        self._log_directory_info(md_dir)
         
-        # ファイルタイプを判定
-        file_type = self._detect_file_type(md_path)
+        # ファイルタイプを判定し、フロントマターと本文を解析
+        file_type, frontmatter, body = self._load_markdown(md_path)
         logging.info(f"検出されたファイルタイプ: {file_type}")
         
-        # フロントマターと本文を解析
-        frontmatter, body = self.parser.parse_frontmatter_and_body(md_path)
-        
         # remote-claude形式の場合、タイトルを適切に設定
         if file_type == 'remote-claude':
-            title = self._generate_remote_claude_title(frontmatter, body, md_path)
-            abstract = self._generate_remote_claude_abstract(frontmatter, body)
+            previews = self._extract_remote_claude_previews(body)
+            title = self._generate_remote_claude_title(frontmatter, previews, md_path)
+            abstract = self._generate_remote_claude_abstract(frontmatter, previews)
         else:
             title = frontmatter.get('title') or md_path.stem
             abstract = frontmatter.get('abstract') or frontmatter.get('summary') or ''
         
-        # MarkdownをNotionブロックに変換
-        blocks = self.converter.convert_markdown_to_blocks(body, md_path.parent.resolve())
+        # MarkdownをNotionブロックに変換（画像アップロード用の接続は変換後に閉じる）
+        try:
+            blocks = self.converter.convert_markdown_to_blocks(body, md_dir)
+        finally:
+            self.converter.image_uploader.close()
         
         # デバッグ情報を表示
         self._log_debug_info(blocks)
@@ -53,38 +106,53 @@ class NotionUploader:
         # ページを作成（メタデータを含む）
         self._create_pages_with_metadata(title, abstract, blocks, frontmatter, file_type)
     
-    def _detect_file_type(self, md_path: Path) -> str:
-        """ファイルのタイプを判定する"""
-        try:
-            content = md_path.read_text(encoding='utf-8')
-            
-            # remote-claude形式のパターン
-            if re.search(r'## 実行記録:\s*\d{4}-\d{2}-\d{2}', content):
-                return 'remote-claude'
-            
-            # Obsidian形式のパターン
-            if re.search(r'\[\[.*?\]\]', content) or re.search(r'>\s*\[!.*?\]', content):
-                return 'obsidian'
-            
-            # 通常のMarkdown
-            return 'standard'
-            
-        except Exception as e:
-            logging.warning(f"ファイルタイプの判定に失敗: {e}")
-            return 'standard'
+    def _load_markdown(self, md_path: Path) -> Tuple[str, Dict[str, str], str]:
+        """ファイルタイプ・フロントマター・本文を返す"""
+        # ファイルは一度だけ読み込み（MarkdownParserのキャッシュを通す）、判定と解析の両方に使う
+        content, frontmatter, body = MarkdownParser.load_markdown(md_path)
+        return self._detect_file_type(content), frontmatter, body
+    
+    @staticmethod
+    def _detect_file_type(content: str) -> str:
+        """ファイルのタイプを判定する（先頭部分だけを調べる）"""
+        end = FILE_TYPE_SCAN_CHARS
+        # フロントマターが先頭部分に収まらない場合は全体を調べる
+        if content.startswith('---') and content.find('\n---', 3, end) == -1:
+            end = len(content)
+        
+        # remote-claude形式のパターン
+        if content.find(_REMOTE_CLAUDE_MARKER, 0, end) != -1 and _REMOTE_CLAUDE_RE.search(content, 0, end):
+            return 'remote-claude'
+        
+        # Obsidian形式のパターン
+        if (content.find('[[', 0, end) != -1 or content.find('[!', 0, end) != -1) \
+                and _OBSIDIAN_RE.search(content, 0, end):
+            return 'obsidian'
+        
+        # 通常のMarkdown
+        return 'standard'
+    
+    def _extract_remote_claude_previews(self, body: str) -> RemoteClaudePreviews:
+        """タイトル・要約に使うプロンプトと結果の抜粋を一度に抽出する"""
+        def clean(match, table) -> Optional[str]:
+            # 改行や特殊文字を除去
+            return match.group(1).strip().translate(table).strip() if match else None
+        
+        return RemoteClaudePreviews(
+            title_prompt=clean(_TITLE_PROMPT_RE.search(body), _PROMPT_CLEAN_TABLE),
+            prompt=clean(_ABSTRACT_PROMPT_RE.search(body), _PROMPT_CLEAN_TABLE),
+            result=clean(_ABSTRACT_RESULT_RE.search(body), _RESULT_CLEAN_TABLE)
+        )
     
-    def _generate_remote_claude_title(self, frontmatter: Dict, body: str, md_path: Path) -> str:
+    def _generate_remote_claude_title(self, frontmatter: Dict, previews: RemoteClaudePreviews, md_path: Path) -> str:
         """remote-claude形式のファイルからタイトルを生成する"""
         # 実行時間があればそれを使用
         if 'execution_time' in frontmatter:
             exec_time = frontmatter['execution_time']
             
-            # プロンプトの最初の部分を抽出
-            prompt_match = re.search(r'>\s*(.{1,50})', body)
-            if prompt_match:
-                prompt_preview = prompt_match.group(1).strip()
-                # 改行や特殊文字を除去
-                prompt_preview = re.sub(r'[>\n\r\t]', ' ', prompt_preview).strip()
+            # プロンプトの最初の部分
+            prompt_preview = previews.title_prompt
+            if prompt_preview is not None:
                 prompt_preview = prompt_preview[:30] + '...' if len(prompt_preview) > 30 else prompt_preview
                 return f"Claude実行記録 - {prompt_preview} ({exec_time})"
             
@@ -93,7 +161,7 @@ class NotionUploader:
         # フォールバック
         return frontmatter.get('title') or md_path.stem
     
-    def _generate_remote_claude_abstract(self, frontmatter: Dict, body: str) -> str:
+    def _generate_remote_claude_abstract(self, frontmatter: Dict, previews: RemoteClaudePreviews) -> str:
         """remote-claude形式のファイルから要約を生成する"""
         abstract_parts = []
         
@@ -104,59 +172,73 @@ class NotionUploader:
         if 'prompt_file' in frontmatter:
             abstract_parts.append(f"プロンプトファイル: {frontmatter['prompt_file']}")
         
-        # プロンプトの最初の部分を抽出
-        prompt_match = re.search(r'### 💬 プロンプト.*?\n>\s*(.{1,100})', body, re.DOTALL)
-        if prompt_match:
-            prompt_preview = prompt_match.group(1).strip()
-            prompt_preview = re.sub(r'[>\n\r\t]', ' ', prompt_preview).strip()
+        # プロンプトの最初の部分
+        prompt_preview = previews.prompt
+        if prompt_preview is not None:
             prompt_preview = prompt_preview[:80] + '...' if len(prompt_preview) > 80 else prompt_preview
             abstract_parts.append(f"プロンプト: {prompt_preview}")
         
-        # 結果の最初の部分を抽出
-        result_match = re.search(r'### ✨ 結果\s*\n(.{1,100})', body, re.DOTALL)
-        if result_match:
-            result_preview = result_match.group(1).strip()
-            result_preview = re.sub(r'[#>\n\r\t]', ' ', result_preview).strip()
+        # 結果の最初の部分
+        result_preview = previews.result
+        if result_preview is not None:
             result_preview = result_preview[:80] + '...' if len(result_preview) > 80 else result_preview
             abstract_parts.append(f"結果: {result_preview}")
         
         return ' | '.join(abstract_parts) if abstract_parts else ''
     
-    def _log_directory_info(self, md_path: Path):
-        """ディレクトリ情報をログ出力する"""
-        md_dir = md_path.parent.resolve()
+    def _log_directory_info(self, md_dir: Path):
+        """ディレクトリ情報をログ出力する（md_dir は解決済みのパス）"""
+        if not logging.getLogger().isEnabledFor(logging.INFO):
+            return
         
-        if md_dir.exists() and md_dir.is_dir():
+        # is_dir() は存在しない場合も False を返すため、exists() での確認は不要
+        if md_dir.is_dir():
             logging.info(f"Markdownディレクトリが存在します: {md_dir}")
             
-            files = list(md_dir.glob('*'))
-            if files:
-                logging.info(f"ディレクトリ内のファイル数: {len(files)}")
-                image_files = [f for f in files if f.suffix.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.svg']]
-                if image_files:
-                    logging.info(f"画像ファイル: {[f.name for f in image_files]}")
+            # 一度の走査でファイル数と画像ファイルを集計
+            file_count = 0
+            image_names = []
+            with os.scandir(md_dir) as entries:
+                for entry in entries:
+                    file_count += 1
+                    if os.path.splitext(entry.name)[1].lower() in _IMG_EXTS:
+                        image_names.append(entry.name)
+            
+            if file_count:
+                logging.info(f"ディレクトリ内のファイル数: {file_count}")
+                if image_names:
+                    logging.info(f"画像ファイル: {image_names}")
     
     def _log_debug_info(self, blocks: List[Dict[str, Any]]):
         """デバッグ情報を表示する"""
-        if logging.getLogger().level <= logging.DEBUG:
-            for i, block in enumerate(blocks):
-                logging.debug(f"Block {i}: {block}")
+        if not logging.getLogger().isEnabledFor(logging.DEBUG):
+            return
+        
+        for i, block in enumerate(blocks):
+            logging.debug("Block %d: %s", i, block)
     
     def _create_pages_with_metadata(self, title: str, abstract: str, blocks: List[Dict[str, Any]], 
                                     frontmatter: Dict, file_type: str):
         """メタデータ付きでページを作成する"""
+        total_blocks = len(blocks)
+        
         # remote-claude形式の場合、メタデータをページ先頭に追加
         if file_type == 'remote-claude' and frontmatter:
             metadata_blocks = self._create_metadata_blocks(frontmatter)
+            total_blocks += len(metadata_blocks)
             # メタデータブロックを先頭に追加
-            blocks = metadata_blocks + blocks
+            blocks = itertools.chain(metadata_blocks, blocks)
         
-        total_blocks = len(blocks)
+        # ブロックを先頭から1ページ分ずつ取り出す（リスト全体の複製を作らない）
+        chunks = _iter_chunks(blocks, self.config.max_blocks_per_page)
+        first_blocks = next(chunks, [])
+        next_blocks = next(chunks, None)
         
-        if total_blocks > self.config.max_blocks_per_page:
-            self._create_multiple_pages(title, abstract, blocks, total_blocks)
+        if next_blocks is not None:
+            self._create_multiple_pages(title, abstract, first_blocks, itertools.chain([next_blocks], chunks),
+                                        total_blocks)
         else:
-            self._create_single_page(title, abstract, blocks)
+            self._create_single_page(title, abstract, first_blocks)
     
     def _create_metadata_blocks(self, frontmatter: Dict) -> List[Dict[str, Any]]:
         """メタデータからNotionブロックを作成する"""
@@ -173,35 +255,10 @@ class NotionUploader:
         })
         
         # メタデータテーブルを作成
-        if 'execution_time' in frontmatter:
-            blocks.append({
-                'object': 'block',
-                'type': 'bulleted_list_item',
-                'bulleted_list_item': {
-                    'rich_text': [{'type': 'text', 'text': {'content': f"⏰ 実行時刻: {frontmatter['execution_time']}"}}],
-                    'color': 'gray_background'
-                }
-            })
-        
-        if 'connection_host' in frontmatter:
-            blocks.append({
-                'object': 'block',
-                'type': 'bulleted_list_item',
-                'bulleted_list_item': {
-                    'rich_text': [{'type': 'text', 'text': {'content': f"🖥️ 接続先: {frontmatter['connection_host']}"}}],
-                    'color': 'gray_background'
-                }
-            })
-        
-        if 'prompt_file' in frontmatter:
-            blocks.append({
-                'object': 'block',
-                'type': 'bulleted_list_item',
-                'bulleted_list_item': {
-                    'rich_text': [{'type': 'text', 'text': {'content': f"📝 プロンプトファイル: {frontmatter['prompt_file']}"}}],
-                    'color': 'gray_background'
-                }
-            })
+        blocks.extend(
+            _metadata_item(f"{label}: {frontmatter[key]}")
+            for key, label in METADATA_FIELDS if key in frontmatter
+        )
         
         # 区切り線を追加
         blocks.append({'object': 'block', 'type': 'divider', 'divider': {}})
@@ -210,43 +267,32 @@ class NotionUploader:
     
     def _create_single_page(self, title: str, abstract: str, blocks: List[Dict[str, Any]]):
         """単一ページを作成する"""
-        new_page = self.notion_client.create_page(title, abstract, blocks)
-        if new_page:
-            logging.info(f"アップロード成功: {new_page['url']}")
-        else:
-            logging.error("ページの作成に失敗しました")
-            raise RuntimeError("ページの作成に失敗しました")
+        try:
+            new_page = self.notion_client.create_page(title, abstract, blocks)
+        except APIResponseError as e:
+            raise RuntimeError(f"ページの作成に失敗しました（{e.code}, HTTP {e.status}）: {e}") from e
+        logging.info(f"アップロード成功: {new_page['url']}")
     
-    def _create_multiple_pages(self, title: str, abstract: str, blocks: List[Dict[str, Any]], total_blocks: int):
+    def _create_multiple_pages(self, title: str, abstract: str, main_blocks: List[Dict[str, Any]],
+                               chunks: Iterator[List[Dict[str, Any]]], total_blocks: int):
         """複数ページに分割して作成する"""
         logging.info(f"ブロック数が多いため複数ページに分割します: {total_blocks}ブロック")
         
         # メインページを作成
-        main_blocks = blocks[:self.config.max_blocks_per_page]
-        main_page = self.notion_client.create_page(title, abstract, main_blocks)
-        
-        if not main_page:
-            logging.error("メインページの作成に失敗しました")
-            raise RuntimeError("メインページの作成に失敗しました")
+        try:
+            main_page = self.notion_client.create_page(title, abstract, main_blocks)
+        except APIResponseError as e:
+            raise RuntimeError(f"メインページの作成に失敗しました（{e.code}, HTTP {e.status}）: {e}") from e
         
         main_page_id = main_page["id"]
         logging.info(f"メインページ作成成功: {main_page['url']}")
         
-        # 残りのブロックを追加ページに分割
-        remaining_blocks = blocks[self.config.max_blocks_per_page:]
-        chunk_size = self.config.max_blocks_per_page
-        chunk_num = 1
-        
-        while remaining_blocks:
-            chunk = remaining_blocks[:chunk_size]
-            remaining_blocks = remaining_blocks[chunk_size:]
-            
-            sub_title = f"{title} (続き {chunk_num})"
-            sub_page = self.notion_client.create_page(sub_title, "", chunk, main_page_id)
-            
-            if sub_page:
-                logging.info(f"追加ページ {chunk_num} 作成成功: {sub_page['url']}")
-                chunk_num += 1
-            else:
-                logging.error(f"追加ページ {chunk_num} の作成に失敗しました")
-                break
+        # 追加ページは番号順に作成する（並行して作成するとNotion上の並びが完了順になる）
+        for chunk_num, chunk in enumerate(chunks, 1):
+            try:
+                sub_page = self.notion_client.create_page(f"{title} (続き {chunk_num})", "", chunk, main_page_id)
+            except APIResponseError as e:
+                # 他の追加ページの作成は続ける
+                logging.error(f"追加ページ {chunk_num} の作成に失敗しました（{e.code}, HTTP {e.status}）: {e}")
+                continue
+            logging.info(f"追加ページ {chunk_num} 作成成功: {sub_page['url']}")